@@ -9,8 +9,32 @@ import httpx
 from openai import OpenAI
 import random
 import os
-import pandas as pd
+from openpyxl import load_workbook
 import threading
+import queue
+import time
+import csv
+import io
+import mmap
+import struct
+import hashlib
+import tempfile
+import bisect
+import sqlite3
+import math
+import pickle
+import argparse
+import datetime
+import sys
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor, as_completed
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # ───────────────────────────────
 # 設定・定数
@@ -19,6 +43,67 @@ import threading
 API_BASE_URL = "http://192.168.19.1:11434/v1"
 API_KEY = "fake-key"
 MODEL_NAME = "gemma3:27b-it-q4_K_M"
+HEALTH_CHECK_INTERVAL = 30.0  # 各サーバーの応答確認の間隔（秒）
+HEALTH_CHECK_TIMEOUT = 5.0
+# 応答が遅いとき、同じ依頼を別のサーバー（またはスロット）にも送り、先に問題が届いた側を使う
+HEDGE_REQUESTS = True
+HEDGE_PERCENTILE = 0.95        # 最近の1問目までの時間のこの分位点を過ぎても届かなければ追加で送る
+HEDGE_DEADLINE_SECONDS = None  # 秒数を指定すると分位点の代わりにこれを使う
+HEDGE_DEFAULT_DEADLINE = 45.0  # 計測が HEDGE_MIN_SAMPLES 回に満たないときの待ち時間
+HEDGE_MIN_SAMPLES = 20
+HEDGE_SAME_ENDPOINT = False    # 別のサーバーがなければ同じサーバーの別スロットに送る
+HEDGE_POLL_SECONDS = 0.2       # 待っている間に中止されたかを確かめる間隔
+STREAM_RESPONSES = True  # 出力を逐次受け取り、1問目ができた時点で出題を始める
+# サーバー側でJSONスキーマに沿った出力に制限する（response_format 対応のサーバーのみ）
+STRUCTURED_OUTPUT = False
+# 問題が足りなくならないよう、必要数の何倍を頼むか（余った問題は問題バンクに未出題で保存）
+OVERGENERATE_RATIO = 1.2
+# 解析や重複排除で問題が足りなくなったとき、不足分だけを追加で頼む回数と、その時間の上限（秒）
+MAX_TOP_UP_ROUNDS = 2
+TOP_UP_BUDGET_SECONDS = 90.0
+# 送る学習データの量をトークン数で決める（行の長さに関係なく、文脈長と待ち時間に収める）
+TOKEN_BUDGET = True
+NUM_CTX = 8192                   # サーバーのコンテキスト長（Ollama の num_ctx）
+PROMPT_TOKEN_BUDGET = 3000       # 学習データに使うトークン数の上限
+PROMPT_LATENCY_TARGET = 6.0      # 学習データの読み込み（プロンプト処理）にかけてよい秒数
+PROMPT_EVAL_TOKENS_PER_SEC = 500.0
+OUTPUT_TOKENS_PER_QUESTION = 90  # 1問の出力に見込むトークン数（文脈長から差し引く）
+BUDGET_MIN_ROWS = 5
+BUDGET_MAX_ROWS = 120
+# 計測した生成速度（トークン/秒）から、目標の秒数で最初の問題が揃うよう問題数と同時リクエスト数を決める
+ADAPTIVE_BATCH = True
+TARGET_READY_SECONDS = 30.0
+# 1回の生成を何件の同時リクエストに分けるか（環境変数 QUIZ_NUM_SHARDS。数値でなければ 1）
+# サーバー側の同時処理数（Ollama なら OLLAMA_NUM_PARALLEL）を超えないようにする
+try:
+    NUM_SHARDS = max(1, int(os.environ.get("QUIZ_NUM_SHARDS", "1")))
+except ValueError:
+    print("QUIZ_NUM_SHARDS は整数で指定してください。1 として続けます")
+    NUM_SHARDS = 1
+# 起動時にモデルを読み込ませておく（Ollama のネイティブAPI）。keep_alive の間はメモリに常駐する
+WARM_UP = True
+KEEP_ALIVE = "30m"
+# 固定の指示（システムメッセージ）の処理結果をサーバーに残して使い回してもらう設定
+# cache_prompt は llama.cpp、keep_alive は Ollama 向け。LLM_ENDPOINTS の extra_body に指定した
+# サーバーにだけ送る（知らない項目を 400 で拒む厳密なAPIには送らない）
+PROMPT_CACHE_OPTIONS = {"cache_prompt": True, "keep_alive": KEEP_ALIVE}
+# 難易度ごとに llama.cpp のスロットを固定する（同じ指示が同じスロットのキャッシュに残る）
+# extra_body を指定したサーバーだけが対象
+# 同時リクエスト（NUM_SHARDS）が2以上のときは、同じスロットで順番待ちになるので使わない
+PIN_SLOTS = False
+SLOT_BY_DIFFICULTY = {"初級": 0, "中級": 1}
+# 使うAIサーバー（OpenAI互換）とモデルの一覧。difficulties の難易度だけをそのサーバーに送る
+# extra_body はそのサーバーにだけ送る追加の項目（省略すると標準の項目だけを送る）
+# 環境変数 QUIZ_LLM_ENDPOINTS に同じ形式のJSONを渡すと置き換えられる（テスト用のサーバーなど）
+LLM_ENDPOINTS = [
+    {"name": "main", "base_url": API_BASE_URL, "model": MODEL_NAME, "difficulties": ["初級", "中級"],
+     "extra_body": PROMPT_CACHE_OPTIONS},
+]
+if os.environ.get("QUIZ_LLM_ENDPOINTS"):
+    LLM_ENDPOINTS = json.loads(os.environ["QUIZ_LLM_ENDPOINTS"])
+# AIサーバーとの接続はプールして使い回す（一括生成では --concurrency に合わせて増やす）
+HTTP_MAX_CONNECTIONS = max(8, NUM_SHARDS * 2)
+HTTP_KEEPALIVE_EXPIRY = 300.0  # 使っていない接続を閉じるまでの秒数
 
 # GUI設定
 COLOR_BG = "#e8f5e9"        # 背景色（薄い緑）
@@ -26,6 +111,7 @@ COLOR_TITLE = "#1b5e20"     # タイトル文字色（濃い緑）
 COLOR_BTN_MAIN = "#66bb6a"  # メインボタン背景
 COLOR_BTN_TEXT = "white"    # メインボタン文字
 COLOR_TEXT_MAIN = "#2e7d32"
+GENERATION_POLL_MS = 100    # 生成スレッドの完了を確認する間隔（ミリ秒）
 
 # 運動プログラムの定義（表示名: ファイル名）
 EXERCISE_PROGRAMS = {
@@ -34,6 +120,1781 @@ EXERCISE_PROGRAMS = {
     "スクワット": "squat_counter.py"
 }
 
+# Excelキャッシュ設定（解析済みデータをワークブックの隣に保存する）
+CACHE_SUFFIX = ".qzcache"
+ROW_HASH_SIZE = 8  # 行ごとの内容ハッシュのバイト数
+
+# 科目カタログ（このフォルダにあるワークブックを科目として一覧にする）
+CORPUS_DIR = "."
+CATALOG_FILE = ".quiz_catalog.json"
+ALL_SUBJECTS = "全科目"
+
+# キーワード検索用の全文検索インデックス（SQLite FTS5）
+FTS_SUFFIX = ".qzfts.sqlite"
+
+# 行の抽出方式
+#   "cache"  : 解析済みキャッシュから抽出（通常）
+#   "stream" : 読み取り専用で1行ずつ読み、DataFrameを作らずに抽出（巨大なExcel向け）
+#   "weighted": 間違えた問題の元になった行ほど選ばれやすくする（苦手克服向け）
+#   "cluster" : 内容の近い少数の行をまとめて選び、プロンプトを短くする（応答の高速化向け）
+SAMPLING_MODE = "cache"
+
+# "cluster" で1問あたりに送る行数と、文字n-gramインデックスの保存先
+CLUSTER_ROWS_PER_QUESTION = 1.5
+NGRAM_SUFFIX = ".qzngram.pickle"
+
+# 出題済みの行をファイルに記録し、次回起動時や同じPCの別ウィンドウと共有する
+PERSISTENT_COVERAGE = True
+COVERAGE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".quiz_coverage")
+
+# 行ごとの苦手度（重み）。不正解で倍、正解で半分（1未満にはしない）
+WEIGHTS_FILE = os.path.join(COVERAGE_DIR, "row_weights.json")
+MAX_ROW_WEIGHT = 16.0
+
+# 生成した問題の保存先（問題バンク）。十分に貯まったらAIを待たずに出題する
+QUESTION_BANK = True
+QUESTION_BANK_FILE = os.path.join(COVERAGE_DIR, "question_bank.sqlite")
+BANK_MIN_QUESTIONS = 30   # これ以上貯まっている科目・難易度はバンクから出題する
+# バンクの問題は行を均等に選んで作ったもの。苦手度や近い行のまとまりを考慮する方式ではバンクを使わない
+BANK_SAMPLING_MODES = ("cache", "stream")
+# 一括生成（python ITgakusyu.py --build-bank）の既定値
+BUILD_WINDOW_ROWS = 30        # 1リクエストに渡す行数（ワークブックを重ならない区間に分ける）
+BUILD_QUESTIONS_PER_WINDOW = 10
+BUILD_CONCURRENCY = 4         # 同時に送るリクエスト数
+BUILD_SAVE_EVERY = 20         # 問題の指紋をファイルに書き出す間隔（区間数。最後にも書き出す）
+# 言い回しを変えただけの問題（ほぼ重複）を過去の問題全体から探して除く
+NEAR_DUPLICATE_CHECK = True
+NEAR_DUPLICATE_THRESHOLD = 0.7  # 問題文の類似度（Jaccard係数の推定値）がこれ以上で正解も同じなら重複
+FINGERPRINT_FILE = os.path.join(COVERAGE_DIR, "question_fingerprints.pickle")
+# 出題中に次の回の問題を先に作っておく数（難易度・出題範囲ごと。0で無効）
+PREFETCH_DEPTH = 1
+# 運動中に作った次の回の問題の受け渡しファイル（次に起動したときに使う）
+HANDOFF_FILE = os.path.join(COVERAGE_DIR, "next_round.json")
+# 計測した生成速度の保存先（ADAPTIVE_BATCH で使う）
+THROUGHPUT_FILE = os.path.join(COVERAGE_DIR, "throughput.json")
+
+# ───────────────────────────────
+# ⓪ Excelキャッシュ（解析済みワークブックのサイドカー）
+# ───────────────────────────────
+def file_signature(filepath):
+    """キャッシュの有効性判定に使う (絶対パス, サイズ, 更新時刻) を返す"""
+    st = os.stat(filepath)
+    return (os.path.abspath(filepath), st.st_size, st.st_mtime_ns)
+
+
+def file_content_hash(filepath, chunk_size=1 << 20):
+    """ファイル内容のSHA-256ハッシュ（16進文字列）を計算する"""
+    h = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def workbook_content_hash(filepath, sheet=0):
+    """ワークブック（のシート）の内容ハッシュ。同じファイルの別シートは別の内容として扱う"""
+    content_hash = file_content_hash(filepath)
+    if sheet:
+        content_hash = hashlib.sha256(f"{content_hash}:{sheet}".encode()).hexdigest()
+    return content_hash
+
+
+def sidecar_path(filepath, suffix=CACHE_SUFFIX, sheet=0):
+    """ワークブック（のシート）に対応するサイドカーファイルのパス（隠しファイル扱い）"""
+    directory, name = os.path.split(os.path.abspath(filepath))
+    if sheet:
+        name = f"{name}.{sheet}"
+    return os.path.join(directory, f".{name}{suffix}")
+
+
+class ParsedWorkbook:
+    """
+    解析済みワークブック。
+    各行をCSV1行分のバイト列として保持し、サイドカーをメモリマップして参照する。
+
+    サイドカー形式:
+        MAGIC(4) | ヘッダ長 uint32 | ヘッダJSON | 行オフセット uint64 × (行数+1)
+        | 行ハッシュ 8バイト × 行数 | 行データ
+    """
+    MAGIC = b"QZC3"
+
+    def __init__(self, buf, header, mm=None):
+        self.header = header
+        self.signature = (header["path"], header["size"], header["mtime_ns"])
+        self.content_hash = header["content_hash"]
+        self.diff = None  # 前回読み込んだ版との差分（RowDiff）
+        self._rows_by_key = None
+        self._buf = buf
+        self._mm = mm
+        n = header["rows"]
+        offsets_pos = header["_offsets_pos"]
+        hashes_pos = offsets_pos + 8 * (n + 1)
+        self._offsets = memoryview(buf)[offsets_pos:hashes_pos].cast("Q")
+        self.row_hashes = memoryview(buf)[hashes_pos:hashes_pos + ROW_HASH_SIZE * n]
+        self._data_pos = hashes_pos + ROW_HASH_SIZE * n
+
+    def __len__(self):
+        return self.header["rows"]
+
+    def row(self, i):
+        """i行目をCSV1行（改行付き）の文字列で返す"""
+        start = self._data_pos + self._offsets[i]
+        end = self._data_pos + self._offsets[i + 1]
+        return bytes(self._buf[start:end]).decode("utf-8")
+
+    def row_key(self, i):
+        """i行目の内容ハッシュ（行の挿入・削除で変わらない行の識別子）"""
+        return self.row_hashes[i * ROW_HASH_SIZE:(i + 1) * ROW_HASH_SIZE].hex()
+
+    def rows_by_key(self):
+        """行の内容ハッシュ -> 行番号のリスト（初回だけ作る）"""
+        if self._rows_by_key is None:
+            rows = {}
+            for i in range(len(self)):
+                rows.setdefault(self.row_key(i), []).append(i)
+            self._rows_by_key = rows
+        return self._rows_by_key
+
+    def to_csv(self, indices):
+        """指定した行だけを、元の df.iloc[...].to_csv() と同じ形式で連結する"""
+        return "".join(self.row(i) for i in indices)
+
+    def selection(self, indices):
+        """指定した行の (内容ハッシュ, CSV1行) のリスト"""
+        return [(self.row_key(i), self.row(i)) for i in indices]
+
+    def close(self):
+        """メモリマップを解放する"""
+        self._offsets.release()
+        self.row_hashes.release()
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+    # --- 直列化 ---
+    @classmethod
+    def encode(cls, header, lines, hashes):
+        """ヘッダと行データ・行ハッシュからサイドカーのバイト列を作る"""
+        blobs = [line.encode("utf-8") for line in lines]
+        offsets = [0]
+        for b in blobs:
+            offsets.append(offsets[-1] + len(b))
+        head = json.dumps(header, ensure_ascii=False).encode("utf-8")
+        # オフセット表を8バイト境界に揃えるためのパディング
+        pad = (-(len(cls.MAGIC) + 4 + len(head))) % 8
+        head += b" " * pad
+        return b"".join([
+            cls.MAGIC,
+            struct.pack("<I", len(head)),
+            head,
+            struct.pack(f"<{len(offsets)}Q", *offsets),
+            hashes,
+            *blobs,
+        ])
+
+    @classmethod
+    def decode_header(cls, buf):
+        """バイト列からヘッダを読み出す（形式が違えば None）"""
+        if len(buf) < 8 or bytes(buf[:4]) != cls.MAGIC:
+            return None
+        (head_len,) = struct.unpack("<I", bytes(buf[4:8]))
+        header = json.loads(bytes(buf[8:8 + head_len]).decode("utf-8"))
+        header["_offsets_pos"] = 8 + head_len
+        return header
+
+    @classmethod
+    def open_sidecar(cls, path, signature):
+        """
+        サイドカーをメモリマップで開く。署名が一致しなければ None
+        signature に None を渡すと署名を確認しない（前回の版の読み出し用）
+        """
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        try:
+            header = cls.decode_header(mm)
+        except (ValueError, struct.error):
+            header = None
+        if not header or signature is not None and \
+                (header.get("path"), header.get("size"), header.get("mtime_ns")) != signature:
+            mm.close()
+            return None
+        return cls(mm, header, mm)
+
+
+def row_content_hash(values):
+    """
+    行の内容ハッシュ。NFKC正規化し、空白の揺れと末尾の空セルを無視するので、
+    見た目が同じ行は同じハッシュになる
+    """
+    cells = [" ".join(unicodedata.normalize("NFKC", v).split()) for v in values]
+    while cells and not cells[-1]:
+        cells.pop()
+    return hashlib.blake2b("\x1f".join(cells).encode("utf-8"), digest_size=ROW_HASH_SIZE).digest()
+
+
+class RowDiff:
+    """
+    前回の版と今回の版の行ハッシュ列の差分。
+    先頭と末尾の一致部分は二分探索で読み飛ばし、間に挟まれた編集範囲だけを
+    ハッシュで突き合わせるので、処理量は編集の大きさに比例する。
+    """
+    def __init__(self, old_hash, old_hashes, new_hashes):
+        self.old_hash = old_hash
+        size = ROW_HASH_SIZE
+        old, new = bytes(old_hashes), bytes(new_hashes)
+        self.old_rows, self.new_rows_total = len(old) // size, len(new) // size
+
+        def common(limit, same):
+            # same(k) が成り立つ最大の k を二分探索（比較自体はC実装の memcmp）
+            lo, hi = 0, limit
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if same(mid):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            return lo
+
+        limit = min(self.old_rows, self.new_rows_total)
+        self.prefix = common(limit, lambda k: old[:k * size] == new[:k * size])
+        self.suffix = common(
+            limit - self.prefix,
+            lambda k: k == 0 or old[len(old) - k * size:] == new[len(new) - k * size:],
+        )
+
+        # 編集範囲だけをハッシュで突き合わせる（行の移動にも対応）
+        old_end = self.old_rows - self.suffix
+        new_end = self.new_rows_total - self.suffix
+        positions = {}
+        for j in range(new_end - 1, self.prefix - 1, -1):
+            positions.setdefault(new[j * size:(j + 1) * size], []).append(j)
+        self._moved = {}
+        for i in range(self.prefix, old_end):
+            candidates = positions.get(old[i * size:(i + 1) * size])
+            if candidates:
+                self._moved[i] = candidates.pop()
+        matched = set(self._moved.values())
+        # 追加・変更された行（今回の版の行番号）
+        self.new_rows = [j for j in range(self.prefix, new_end) if j not in matched]
+        self.removed_count = (old_end - self.prefix) - len(self._moved)
+
+    def map_old(self, i):
+        """前回の版の行番号を今回の版の行番号に変換する（削除・変更された行は None）"""
+        if i < self.prefix:
+            return i
+        if i >= self.old_rows - self.suffix:
+            return i + self.new_rows_total - self.old_rows
+        return self._moved.get(i)
+
+
+def cell_text(value):
+    """
+    セルの値を文字列にする（空セルは空文字）。キャッシュ経由でも1行ずつ読む場合でも
+    この関数で書式を揃えるので、同じ行は同じCSV・同じ内容ハッシュになる
+    """
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime) and value.time() == datetime.time():
+        return value.date().isoformat()  # 時刻のない日付は日付だけ
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_csv_row(values):
+    """セルの値のリストをCSV1行（改行付き）に変換する（空セルは空文字）"""
+    out = io.StringIO()
+    csv.writer(out, lineterminator="\n").writerow([cell_text(v) for v in values])
+    return out.getvalue()
+
+
+def iter_excel_rows(filepath, sheet=0):
+    """
+    シート（番号）を読み取り専用モードで1行ずつ返すイテレータ。
+    シート全体をメモリに載せないので、巨大なファイルでも使用メモリは一定。
+    """
+    wb = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        for values in wb.worksheets[sheet].iter_rows(values_only=True):
+            yield values
+    finally:
+        wb.close()
+
+
+def excel_row_count(filepath, sheet=0):
+    """
+    シートの行数（末尾の空行を除く、キャッシュの行数と同じ数え方）。
+    まずシートの寸法情報を使い、寸法が無い・末尾が空行なら数え直す。
+    """
+    wb = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheet]
+        rows = ws.max_row
+        if rows:
+            last = next(ws.iter_rows(min_row=rows, max_row=rows, values_only=True), ())
+            if any(v is not None for v in last):
+                return rows
+    finally:
+        wb.close()
+    rows = 0
+    for i, values in enumerate(iter_excel_rows(filepath, sheet)):
+        if any(v is not None for v in values):
+            rows = i + 1
+    return rows
+
+
+class WorkbookCache:
+    """
+    (パス, サイズ, 更新時刻) をキーにした解析済みワークブックのキャッシュ。
+    初回はExcelを解析してサイドカーを書き出し、以降（他のプロセスも含む）は
+    サイドカーをメモリマップするだけで済ませる。シートごとに別のサイドカーを持つ。
+    """
+    def __init__(self):
+        self._books = {}
+
+    def load(self, filepath, sheet=0):
+        signature = file_signature(filepath)
+        key = (signature[0], sheet)
+        book = self._books.get(key)
+        if book is not None and book.signature == signature:
+            return book
+
+        # 古いキャッシュは先に解放（Windowsではマップ中のファイルを置き換えられない）
+        # 差分を取るために、前回の版の行ハッシュだけは控えておく
+        previous = self._books.pop(key, None)
+        path = sidecar_path(filepath, sheet=sheet)
+        book = ParsedWorkbook.open_sidecar(path, signature)
+        if book is None and previous is None:
+            previous = ParsedWorkbook.open_sidecar(path, None)
+        previous_rows = None
+        if previous is not None:
+            previous_rows = (previous.content_hash, bytes(previous.row_hashes))
+            previous.close()
+
+        if book is None:
+            book = self._build(filepath, signature, path, sheet)
+        if previous_rows is not None and previous_rows[0] != book.content_hash:
+            book.diff = RowDiff(previous_rows[0], previous_rows[1], book.row_hashes)
+            print(
+                f"Excelの変更を検出: 追加・変更 {len(book.diff.new_rows)}行 / "
+                f"削除 {book.diff.removed_count}行"
+            )
+        self._books[key] = book
+        return book
+
+    def _build(self, filepath, signature, path, sheet=0):
+        """Excelを解析してサイドカーを作成する"""
+        # 1行ずつ読む抽出（stream）と同じ読み方・同じ書式にして、内容ハッシュを揃える
+        rows = list(iter_excel_rows(filepath, sheet))
+        while rows and all(v is None for v in rows[-1]):
+            rows.pop()  # 末尾の空行は除く
+        rows = [[cell_text(v) for v in values] for values in rows]
+        lines = [format_csv_row(values) for values in rows]
+        hashes = b"".join(row_content_hash(values) for values in rows)
+
+        header = {
+            "path": signature[0],
+            "sheet": sheet,
+            "size": signature[1],
+            "mtime_ns": signature[2],
+            "rows": len(lines),
+            "content_hash": workbook_content_hash(filepath, sheet),
+        }
+        data = ParsedWorkbook.encode(header, lines, hashes)
+
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".qzcache-")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            # 書き込めない場所でもキャッシュはメモリ上で使う
+            print(f"キャッシュを書き込めませんでした: {e}")
+            return ParsedWorkbook(data, ParsedWorkbook.decode_header(data))
+
+        return ParsedWorkbook.open_sidecar(path, signature) or \
+            ParsedWorkbook(data, ParsedWorkbook.decode_header(data))
+
+# ───────────────────────────────
+# 科目カタログ（複数のワークブック・シートの目録）
+# ───────────────────────────────
+class CorpusCatalog:
+    """
+    フォルダ内のワークブックとシートを「科目」として一覧にした目録。
+    行数・内容ハッシュ・通し行番号の開始位置を目録ファイルに保存しておき、
+    更新されたファイルだけを読み直す。全科目からの抽出では、選ばれた行を
+    含むワークブックだけを開けばよい。
+    """
+    def __init__(self, directory=CORPUS_DIR, cache=None):
+        self.directory = directory
+        self.cache = cache or WorkbookCache()
+        self.path = os.path.join(directory, CATALOG_FILE)
+        self.entries = []
+        self.content_hash = ""
+
+    @staticmethod
+    def is_workbook(name):
+        # Excelの一時ファイル（~$）や隠しファイルは対象外
+        return name.lower().endswith((".xlsx", ".xlsm")) and not name.startswith(("~$", "."))
+
+    def _read_index(self):
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                return json.load(f).get("entries", [])
+        except (OSError, ValueError):
+            return []
+
+    def _write_index(self):
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".quiz_catalog-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"entries": self.entries}, f, ensure_ascii=False, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"目録を書き込めませんでした: {e}")
+
+    def load_index(self):
+        """保存してある目録をそのまま読み込む（フォルダは走査しないのですぐ終わる）"""
+        self.entries = self._read_index()
+        self.content_hash = hashlib.sha256(
+            "".join(e["hash"] for e in self.entries).encode()
+        ).hexdigest()
+        return self
+
+    def scan(self):
+        """フォルダを走査して目録を更新する（変更のないファイルは開かない）"""
+        previous = {}
+        for entry in self._read_index():
+            previous.setdefault(entry["path"], []).append(entry)
+
+        entries = []
+        for name in sorted(os.listdir(self.directory)):
+            if not self.is_workbook(name):
+                continue
+            path = os.path.join(self.directory, name)
+            _, size, mtime_ns = file_signature(path)
+            known = previous.get(path, [])
+            if known and all(e["size"] == size and e["mtime_ns"] == mtime_ns for e in known):
+                entries.extend(known)
+                continue
+            try:
+                wb = load_workbook(path, read_only=True)
+                sheet_names = wb.sheetnames
+                wb.close()
+                stem = os.path.splitext(name)[0]
+                for sheet, sheet_name in enumerate(sheet_names):
+                    book = self.cache.load(path, sheet)
+                    entries.append({
+                        "subject": stem if len(sheet_names) == 1 else f"{stem} / {sheet_name}",
+                        "path": path,
+                        "sheet": sheet,
+                        "rows": len(book),
+                        "hash": book.content_hash,
+                        "size": size,
+                        "mtime_ns": mtime_ns,
+                    })
+            except Exception as e:
+                print(f"目録に追加できませんでした: {name}: {e}")
+
+        # 全科目を通した行番号の開始位置
+        offset = 0
+        for entry in entries:
+            entry["offset"] = offset
+            offset += entry["rows"]
+
+        changed = entries != [e for es in previous.values() for e in es]
+        self.entries = entries
+        self.content_hash = hashlib.sha256(
+            "".join(e["hash"] for e in entries).encode()
+        ).hexdigest()
+        if changed:
+            self._write_index()
+        return self
+
+    @property
+    def total_rows(self):
+        return sum(e["rows"] for e in self.entries)
+
+    def subjects(self):
+        return [e["subject"] for e in self.entries]
+
+    def find(self, subject):
+        for entry in self.entries:
+            if entry["subject"] == subject:
+                return entry
+        return None
+
+    def locate(self, index):
+        """全科目の通し行番号を (目録の項目, シート内の行番号) に変換する"""
+        pos = bisect.bisect_right([e["offset"] for e in self.entries], index) - 1
+        entry = self.entries[pos]
+        return entry, index - entry["offset"]
+
+    def to_csv(self, indices):
+        """通し行番号の行を、ワークブックごとにまとめて読み出す"""
+        by_entry = {}
+        for index in indices:
+            entry, row = self.locate(index)
+            by_entry.setdefault((entry["path"], entry["sheet"]), []).append(row)
+        parts = []
+        for (path, sheet), rows in by_entry.items():
+            parts.append(self.cache.load(path, sheet).to_csv(rows))
+        return "".join(parts)
+
+    def selection(self, indices):
+        """通し行番号の行の (内容ハッシュ, CSV1行) のリスト"""
+        result = []
+        for index in indices:
+            entry, row = self.locate(index)
+            result.extend(self.cache.load(entry["path"], entry["sheet"]).selection([row]))
+        return result
+
+
+# ───────────────────────────────
+# キーワード検索（全文検索インデックス）
+# ───────────────────────────────
+def normalize_search_text(text):
+    """検索用の正規化（全角・半角と大文字・小文字を統一）"""
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+class TopicIndex:
+    """
+    ワークブックの行をキーワードで引くための SQLite FTS5 インデックス。
+    行は内容ハッシュで管理するので、Excelが編集されたときは
+    追加・削除された行だけを書き換える。
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS meta(key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS row_keys(docid INTEGER PRIMARY KEY, row_key TEXT UNIQUE);
+        """)
+        self.tokenizer = self._meta("tokenizer")
+        if self.tokenizer is None:
+            # 日本語は単語で区切れないため trigram（3文字単位）を優先する
+            for tokenizer in ("trigram", "unicode61"):
+                try:
+                    self.conn.execute(
+                        f"CREATE VIRTUAL TABLE rows USING fts5(content, tokenize='{tokenizer}')"
+                    )
+                except sqlite3.OperationalError:
+                    continue
+                self.tokenizer = tokenizer
+                self._set_meta("tokenizer", tokenizer)
+                break
+            self.conn.commit()
+
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, value))
+
+    def sync(self, book):
+        """ワークブックの内容に合わせてインデックスを更新する（変更がなければ何もしない）"""
+        with self._lock:
+            if self._meta("content_hash") == book.content_hash:
+                return
+            wanted = {}
+            for key, rows in book.rows_by_key().items():
+                wanted[key] = rows[0]
+            existing = dict(self.conn.execute("SELECT row_key, docid FROM row_keys"))
+
+            with self.conn:
+                removed = [(docid,) for key, docid in existing.items() if key not in wanted]
+                self.conn.executemany("DELETE FROM rows WHERE rowid = ?", removed)
+                self.conn.executemany("DELETE FROM row_keys WHERE docid = ?", removed)
+                for key, i in wanted.items():
+                    if key in existing:
+                        continue
+                    cur = self.conn.execute("INSERT INTO row_keys(row_key) VALUES (?)", (key,))
+                    self.conn.execute(
+                        "INSERT INTO rows(rowid, content) VALUES (?, ?)",
+                        (cur.lastrowid, normalize_search_text(book.row(i))),
+                    )
+                self._set_meta("content_hash", book.content_hash)
+
+    def search(self, keywords, book):
+        """いずれかのキーワードを含む行の行番号を返す"""
+        terms = [normalize_search_text(t) for t in re.split(r"[\s,、，]+", keywords) if t]
+        if not terms:
+            return []
+        # trigram は3文字以上の語を索引で引ける。短い語は LIKE で探す
+        match_terms = [t for t in terms if self.tokenizer == "trigram" and len(t) >= 3]
+        like_terms = [t for t in terms if t not in match_terms]
+
+        keys = set()
+        with self._lock:
+            if match_terms:
+                query = " OR ".join('"' + t.replace('"', '""') + '"' for t in match_terms)
+                keys.update(k for (k,) in self.conn.execute(
+                    "SELECT k.row_key FROM rows JOIN row_keys k ON k.docid = rows.rowid "
+                    "WHERE rows MATCH ?", (query,)))
+            for t in like_terms:
+                pattern = "%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                keys.update(k for (k,) in self.conn.execute(
+                    "SELECT k.row_key FROM rows JOIN row_keys k ON k.docid = rows.rowid "
+                    "WHERE rows.content LIKE ? ESCAPE '\\'", (pattern,)))
+
+        rows_by_key = book.rows_by_key()
+        return sorted(i for key in keys for i in rows_by_key.get(key, []))
+
+    def close(self):
+        self.conn.close()
+
+
+# ───────────────────────────────
+# 行サンプラー（重複なし抽出）
+# ───────────────────────────────
+class RowSampler:
+    """
+    行番号 0..n-1 を重複なしで抽出するサンプラー。
+    並べ替えを「必要になった位置だけ」記録するフィッシャー–イェーツ法なので、
+    k行の抽出は O(k)、使用済み判定は O(1)、メモリは使用済みの行数分だけで済む。
+    """
+    def __init__(self):
+        self.total_rows = 0
+        self.reset()
+
+    def reset(self):
+        """履歴をリセットする"""
+        self._value = {}   # 位置 -> 行番号（入れ替えた位置だけ）
+        self._pos = {}     # 行番号 -> 位置（入れ替えた行番号だけ）
+        self._cursor = 0   # 先頭から _cursor 個の位置が使用済み
+
+    def resize(self, total_rows):
+        """行数が変わった（Excelが編集された）場合は履歴を捨てる"""
+        if total_rows != self.total_rows:
+            self.total_rows = total_rows
+            self.reset()
+
+    @property
+    def used_count(self):
+        return self._cursor
+
+    @property
+    def used_indices(self):
+        """使用済みの行番号（抽出した順）"""
+        return [self._value.get(p, p) for p in range(self._cursor)]
+
+    def is_used(self, i):
+        return self._pos.get(i, i) < self._cursor
+
+    def used_snapshot(self):
+        """多くの行を続けて調べるための使用済み判定の関数"""
+        return self.is_used
+
+    def _swap(self, a, b):
+        va, vb = self._value.get(a, a), self._value.get(b, b)
+        self._value[a], self._value[b] = vb, va
+        self._pos[vb], self._pos[va] = a, b
+
+    def mark(self, indices):
+        """指定した行を使用済みにする"""
+        for i in indices:
+            p = self._pos.get(i, i)
+            if p >= self._cursor:
+                self._swap(p, self._cursor)
+                self._cursor += 1
+
+    def draw(self, k):
+        """未使用の行からランダムに最大k行を選び、使用済みにする"""
+        n = self.total_rows
+        # もし未使用データが足りなければ、履歴をリセットして全データから選ぶ
+        if n - self._cursor < k and self._cursor > 0:
+            print("データが一巡しました。履歴をリセットして再利用します。")
+            self.reset()
+
+        selected = []
+        for _ in range(min(k, n - self._cursor)):
+            j = random.randrange(self._cursor, n)
+            self._swap(self._cursor, j)
+            selected.append(self._value[self._cursor])
+            self._cursor += 1
+        return selected
+
+
+class FileLock:
+    """プロセス間で共有する排他ロック（with 文で使う）"""
+    def __init__(self, path):
+        self._file = open(path, "a+b")
+
+    def __enter__(self):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue  # LK_LOCK は約10秒で諦めるので取れるまで繰り返す
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        self._file.close()
+
+
+class SharedCoverageSampler:
+    """
+    出題済みの行をビットマップファイルに記録する RowSampler 互換のサンプラー。
+    ワークブックの内容ハッシュごとに1ファイルをメモリマップし、ファイルロックで
+    守るので、アプリを終了しても、同じPCで複数起動しても出題済みの行を共有できる。
+
+    ファイル形式: MAGIC(4) | 行数 uint64 | 使用済み数 uint64 | パディング(4) | ビット列
+
+    マップはロックを持っている間だけ張る。Windows はどこかのプロセスがマップ
+    している間はファイルの大きさを変えられないので、行数の変更（切り詰め）も
+    ロックの中で、どのプロセスもマップしていない状態で行う。
+    """
+    MAGIC = b"QZB1"
+    HEADER = struct.Struct("<4sQQ4x")
+
+    def __init__(self, key, total_rows=0, directory=COVERAGE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{key}.bitmap")
+        self._lock = FileLock(self.path + ".lock")
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._file = os.fdopen(fd, "r+b")
+        self._mm = None
+        with self._lock:
+            size = os.fstat(fd).st_size
+            header = self._file.read(self.HEADER.size) if size >= self.HEADER.size else b""
+            if len(header) < self.HEADER.size or header[:4] != self.MAGIC:
+                # 新規作成（最初から全行分の大きさで作り、後から伸ばさずに済ませる）
+                self._file.seek(0)
+                self._file.truncate(self.HEADER.size + (total_rows + 7) // 8)
+                self._file.write(self.HEADER.pack(self.MAGIC, total_rows, 0))
+                self._file.flush()
+
+    # --- ヘッダとマップの管理 ---
+    @contextmanager
+    def _map(self):
+        """その時点のファイルの大きさでマップを張る（抜けると外す）"""
+        self._mm = mmap.mmap(self._file.fileno(), os.fstat(self._file.fileno()).st_size)
+        try:
+            yield
+        finally:
+            self._mm.close()
+            self._mm = None
+
+    @contextmanager
+    def _mapped(self):
+        """ロックを取ってからマップを張る"""
+        with self._lock, self._map():
+            yield
+
+    def _header(self):
+        _, total, used = self.HEADER.unpack_from(self._mm, 0)
+        return total, used
+
+    def _set_header(self, total, used):
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, total, used)
+
+    def _bit(self, i):
+        return self._mm[self.HEADER.size + (i >> 3)] >> (i & 7) & 1
+
+    def _set_bit(self, i):
+        pos = self.HEADER.size + (i >> 3)
+        self._mm[pos] = self._mm[pos] | (1 << (i & 7))
+
+    def _clear(self, total):
+        nbytes = (total + 7) // 8
+        self._mm[self.HEADER.size:self.HEADER.size + nbytes] = bytes(nbytes)
+        self._set_header(total, 0)
+
+    # --- RowSampler と同じインターフェース ---
+    @property
+    def total_rows(self):
+        with self._mapped():
+            return self._header()[0]
+
+    @property
+    def used_count(self):
+        with self._mapped():
+            return self._header()[1]
+
+    @property
+    def used_indices(self):
+        """使用済みの行番号（行番号順）"""
+        with self._mapped():
+            total, _ = self._header()
+            return [i for i in range(total) if self._bit(i)]
+
+    def reset(self):
+        """履歴をリセットする"""
+        with self._mapped():
+            self._clear(self._header()[0])
+
+    def resize(self, total_rows):
+        """行数が変わった場合は、マップを外してからファイルを切り詰め、履歴を捨てる"""
+        with self._lock:
+            with self._map():
+                if self._header()[0] == total_rows:
+                    return
+            self._file.truncate(self.HEADER.size + (total_rows + 7) // 8)
+            with self._map():
+                self._clear(total_rows)
+
+    def is_used(self, i):
+        with self._mapped():
+            return i < self._header()[0] and bool(self._bit(i))
+
+    def used_snapshot(self):
+        """
+        多くの行を続けて調べるための使用済み判定の関数
+        ビット列を1回だけ読み出して使う（行ごとにロックやマップを取り直さない）
+        """
+        with self._mapped():
+            total, _ = self._header()
+            bitmap = self._mm[self.HEADER.size:self.HEADER.size + (total + 7) // 8]
+        return lambda i: i < total and bool(bitmap[i >> 3] >> (i & 7) & 1)
+
+    def mark(self, indices):
+        """指定した行を使用済みにする"""
+        with self._mapped():
+            total, used = self._header()
+            for i in indices:
+                if i < total and not self._bit(i):
+                    self._set_bit(i)
+                    used += 1
+            self._set_header(total, used)
+
+    def draw(self, k):
+        """未使用の行からランダムに最大k行を選び、使用済みにする"""
+        with self._mapped():
+            n, used = self._header()
+            # もし未使用データが足りなければ、履歴をリセットして全データから選ぶ
+            if n - used < k and used > 0:
+                print("データが一巡しました。履歴をリセットして再利用します。")
+                self._clear(n)
+                used = 0
+
+            k = min(k, n - used)
+            if (n - used) * 16 >= n:
+                # 未使用が十分に多い間は、乱数で引いて使用済みなら引き直す（期待値 O(k)）
+                selected = set()
+                while len(selected) < k:
+                    i = random.randrange(n)
+                    if i not in selected and not self._bit(i):
+                        selected.add(i)
+                selected = list(selected)
+                random.shuffle(selected)
+            else:
+                # 残りが少ないときは未使用の行を列挙してから選ぶ
+                base = self.HEADER.size
+                unused = []
+                bitmap = self._mm[base:base + (n + 7) // 8]
+                for m in re.finditer(rb"[^\xff]", bitmap):  # 全ビット使用済みのバイトは飛ばす
+                    b, byte = m.start(), bitmap[m.start()]
+                    unused.extend(
+                        i for i in range(b * 8, min(b * 8 + 8, n)) if not byte >> (i & 7) & 1
+                    )
+                selected = random.sample(unused, k)
+
+            for i in selected:
+                self._set_bit(i)
+            self._set_header(n, used + k)
+            return selected
+
+    def close(self):
+        self._file.close()
+        self._lock.close()
+
+
+# ───────────────────────────────
+# 内容の近い行のまとまり（文字n-gramのTF-IDF）
+# ───────────────────────────────
+class NgramIndex:
+    """
+    行ごとの文字2-gram TF-IDF ベクトルと転置インデックス。
+    起点の行から、珍しいn-gramを共有する行だけを候補にして類似度を計算するので、
+    行数が多くても近い行のまとまりをすぐに取り出せる。
+    """
+    MAX_DF_RATIO = 0.05   # これより多くの行に出るn-gramは候補探しに使わない
+    SEED_GRAMS = 12       # 起点の行から候補探しに使うn-gramの数
+    VERSION = 2           # 保存形式（変えたら保存済みのインデックスを作り直す）
+
+    def __init__(self, content_hash, vectors, postings, terms):
+        self.content_hash = content_hash
+        self.vectors = vectors    # 行ごとの {n-gram番号: 重み}（L2正規化済み）
+        self.postings = postings  # n-gram番号 -> その n-gram を含む行番号のリスト
+        self.terms = terms        # 行ごとの正規化した答えの語のタプル（正解の重複判定用）
+
+    @staticmethod
+    def answer_terms(cells):
+        """
+        行の答えになる語（正規化済み）。先頭の列は文章なので2列目以降のキーワードを使い、
+        1列しかなければその列を使う
+        """
+        answers = [normalize_answer(c) for c in cells[1:]] if len(cells) > 1 else cells[:1]
+        return tuple(a for a in answers if a)
+
+    @staticmethod
+    def grams(text):
+        t = normalize_answer(text)
+        return [t[i:i + 2] for i in range(len(t) - 1)] or ([t] if t else [])
+
+    @classmethod
+    def build(cls, book):
+        vocab, counts = {}, []
+        for i in range(len(book)):
+            c = {}
+            for g in cls.grams(book.row(i)):
+                gid = vocab.setdefault(g, len(vocab))
+                c[gid] = c.get(gid, 0) + 1
+            counts.append(c)
+
+        postings = {}
+        for i, c in enumerate(counts):
+            for gid in c:
+                postings.setdefault(gid, []).append(i)
+        n = len(counts)
+        idf = {gid: math.log(n / len(rows)) + 1.0 for gid, rows in postings.items()}
+
+        vectors = []
+        for c in counts:
+            v = {gid: tf * idf[gid] for gid, tf in c.items()}
+            norm = math.sqrt(sum(w * w for w in v.values())) or 1.0
+            vectors.append({gid: w / norm for gid, w in v.items()})
+
+        max_df = max(2, int(n * cls.MAX_DF_RATIO))
+        postings = {gid: rows for gid, rows in postings.items() if len(rows) <= max_df}
+        terms = [
+            cls.answer_terms(next(csv.reader(io.StringIO(book.row(i))), None) or [])
+            for i in range(n)
+        ]
+        return cls(book.content_hash, vectors, postings, terms)
+
+    @classmethod
+    def load_or_build(cls, book, path):
+        """保存済みのインデックスが同じ内容のものなら読み込み、違えば作り直して保存する"""
+        try:
+            with open(path, "rb") as f:
+                data = pickle.load(f)
+            if data.pop("version", None) == cls.VERSION and data.get("content_hash") == book.content_hash:
+                return cls(**data)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, TypeError):
+            pass
+        index = cls.build(book)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".qzngram-")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(dict(vars(index), version=cls.VERSION), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"n-gramインデックスを保存できませんでした: {e}")
+        return index
+
+    def similarity(self, i, j):
+        a, b = self.vectors[i], self.vectors[j]
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(w * b.get(gid, 0.0) for gid, w in a.items())
+
+    def cluster(self, seed, size, is_used):
+        """
+        起点の行に近い行を最大 size 行選ぶ。未使用の行を優先し、
+        答えになる語（キーワードの列）が既に選んだ行と重なる行や、ほぼ同じ内容の行は除く。
+        is_used には多くの行を続けて調べられる判定（used_snapshot）を渡す。
+        """
+        seed_vec = self.vectors[seed]
+        top = sorted(seed_vec, key=seed_vec.get, reverse=True)[:self.SEED_GRAMS]
+        candidates = {j for gid in top for j in self.postings.get(gid, ()) if j != seed}
+        ranked = sorted(
+            candidates,
+            key=lambda j: (is_used(j), -self.similarity(seed, j)),
+        )
+
+        chosen, terms = [seed], set(self.terms[seed])
+        for j in ranked:
+            if len(chosen) >= size:
+                break
+            if terms.intersection(self.terms[j]):
+                continue
+            if any(self.similarity(j, k) > 0.9 for k in chosen):
+                continue
+            chosen.append(j)
+            terms.update(self.terms[j])
+        return chosen
+
+
+# ───────────────────────────────
+# 苦手な行を優先する重み付きサンプラー
+# ───────────────────────────────
+class RowWeights:
+    """行の内容ハッシュごとの苦手度をファイルに保存する（既定値 1.0 の行は保存しない）"""
+    def __init__(self, path=WEIGHTS_FILE):
+        self.path = path
+        self._weights = None
+
+    def _load(self):
+        if self._weights is None:
+            try:
+                with open(self.path, encoding="utf-8") as f:
+                    self._weights = json.load(f)
+            except (OSError, ValueError):
+                self._weights = {}
+        return self._weights
+
+    def get(self, key):
+        return self._load().get(key, 1.0)
+
+    def update(self, key, is_correct):
+        """回答結果に応じて苦手度を更新し、新しい値を返す"""
+        weights = self._load()
+        w = weights.get(key, 1.0)
+        w = max(1.0, w / 2) if is_correct else min(MAX_ROW_WEIGHT, w * 2)
+        if w == 1.0:
+            weights.pop(key, None)
+        else:
+            weights[key] = w
+        return w
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".weights-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(self._load(), f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"苦手度を保存できませんでした: {e}")
+
+
+class FenwickSampler:
+    """
+    重みに比例した確率で行を選ぶサンプラー（フェニック木）。
+    1行の抽出も重みの更新も O(log n) なので、巨大なワークブックでも軽い。
+    """
+    def __init__(self, weights):
+        self.weights = list(weights)
+        n = self.n = len(self.weights)
+        # O(n) で木を組み立てる
+        tree = [0.0] + self.weights
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+        self._top = 1 << (n.bit_length() - 1) if n else 0
+
+    def total(self):
+        i, s = self.n, 0.0
+        while i > 0:
+            s += self._tree[i]
+            i -= i & -i
+        return s
+
+    def update(self, i, weight):
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        i += 1
+        while i <= self.n:
+            self._tree[i] += delta
+            i += i & -i
+
+    def _find(self, x):
+        """累積重みが x を超える最初の行番号"""
+        pos, step = 0, self._top
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and self._tree[nxt] <= x:
+                pos = nxt
+                x -= self._tree[nxt]
+            step >>= 1
+        return min(pos, self.n - 1)
+
+    def sample(self, k):
+        """重みに比例して、重複なしで最大k行を選ぶ"""
+        picked = []
+        for _ in range(min(k, self.n)):
+            total = self.total()
+            if total <= 0:
+                break
+            i = self._find(random.random() * total)
+            if self.weights[i] <= 0:
+                break  # 浮動小数の誤差で重み0の行に当たった場合
+            picked.append((i, self.weights[i]))
+            self.update(i, 0.0)  # 同じ行を二度選ばないよう一時的に0にする
+        for i, w in picked:
+            self.update(i, w)
+        return [i for i, _ in picked]
+
+
+def normalize_answer(t):
+    """全角・半角や大文字・小文字を統一し、記号を除いた比較用の文字列"""
+    t = unicodedata.normalize("NFKC", t.lower())
+    return "".join(
+        c for c in t if c.isalnum() or "\u3040" <= c <= "\u9faf"
+    )
+
+
+# ───────────────────────────────
+# 問題バンク（生成済みの問題の保存と再出題）
+# ───────────────────────────────
+class QuestionBank:
+    """
+    生成した問題を SQLite に保存し、最後に出題してから時間の経った順に再出題する。
+    出題範囲・難易度・元の行の内容ハッシュ・モデル名・出題回数で引けるよう索引を張る。
+    """
+    def __init__(self, path=QUESTION_BANK_FILE):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS questions(
+                id INTEGER PRIMARY KEY,
+                source TEXT NOT NULL,          -- 出題範囲（ワークブック・シート・フォルダ）
+                difficulty TEXT NOT NULL,
+                question TEXT NOT NULL,
+                payload TEXT NOT NULL,         -- 問題のJSON
+                model TEXT,
+                served_count INTEGER NOT NULL DEFAULT 0,
+                last_served REAL NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                UNIQUE(source, difficulty, question)
+            );
+            CREATE TABLE IF NOT EXISTS question_rows(
+                question_id INTEGER NOT NULL REFERENCES questions(id) ON DELETE CASCADE,
+                row_key TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_questions_rotation
+                ON questions(source, difficulty, last_served);
+            CREATE INDEX IF NOT EXISTS idx_questions_served ON questions(source, difficulty, served_count);
+            CREATE INDEX IF NOT EXISTS idx_questions_model ON questions(model);
+            CREATE INDEX IF NOT EXISTS idx_question_rows_key ON question_rows(row_key);
+            CREATE INDEX IF NOT EXISTS idx_question_rows_question ON question_rows(question_id);
+            CREATE TABLE IF NOT EXISTS build_windows(
+                source TEXT NOT NULL,
+                difficulty TEXT NOT NULL,
+                window_key TEXT NOT NULL,      -- 区間に含まれる行の内容ハッシュ
+                PRIMARY KEY(source, difficulty, window_key)
+            );
+        """)
+
+    def add(self, source, difficulty, quiz_list, model=None, served=False):
+        """
+        問題を保存する（同じ問題文は1つだけ）。served=True なら出題済みとして記録。
+        モデル名は問題ごとの "model"（応答したサーバーのモデル）、なければ model を記録する。
+        新しく保存した問題のリストを返す
+        """
+        now = time.time()
+        added = []
+        with self._lock, self.conn:
+            for quiz in quiz_list:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO questions"
+                    "(source, difficulty, question, payload, model, served_count, last_served, created)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (source, difficulty, quiz["question"], json.dumps(quiz, ensure_ascii=False),
+                     quiz.get("model", model), 1 if served else 0, now if served else 0, now),
+                )
+                if cur.rowcount:
+                    self.conn.executemany(
+                        "INSERT INTO question_rows(question_id, row_key) VALUES (?, ?)",
+                        [(cur.lastrowid, key) for key in quiz.get("source_rows") or []],
+                    )
+                    added.append(quiz)
+        return added
+
+    def count(self, source, difficulty, unserved_only=False):
+        sql = "SELECT COUNT(*) FROM questions WHERE source = ? AND difficulty = ?"
+        if unserved_only:
+            sql += " AND served_count = 0"
+        with self._lock:
+            return self.conn.execute(sql, (source, difficulty)).fetchone()[0]
+
+    def serve(self, source, difficulty, num_questions, valid_rows=None):
+        """
+        最後に出題してから時間の経った順に num_questions 問を取り出し、出題済みにする。
+        valid_rows（行の内容ハッシュの集合）を渡すと、元の行が今のExcelに残っている問題だけを使う。
+        元の行が削除・変更された問題はバンクから外すので、次からは並びの先頭を塞がない。
+        足りなければ None
+        """
+        with self._lock, self.conn:
+            picked, stale = [], []
+            after = (-1.0, -1)  # (last_served, id) がこれより後の問題から続きを読む
+            while len(picked) < num_questions:
+                rows = self.conn.execute(
+                    "SELECT id, payload, last_served FROM questions WHERE source = ? AND difficulty = ?"
+                    " AND (last_served > ? OR (last_served = ? AND id > ?))"
+                    " ORDER BY last_served, id LIMIT ?",
+                    (source, difficulty, after[0], after[0], after[1], num_questions * 3),
+                ).fetchall()
+                for qid, payload, last_served in rows:
+                    quiz = json.loads(payload)
+                    keys = quiz.get("source_rows") or []
+                    if valid_rows is not None and keys and not any(k in valid_rows for k in keys):
+                        stale.append(qid)  # 元の行が削除・変更された問題は出さない
+                        continue
+                    picked.append((qid, quiz))
+                    if len(picked) == num_questions:
+                        break
+                if len(rows) < num_questions * 3:
+                    break
+                after = (rows[-1][2], rows[-1][0])
+            if stale:
+                self.conn.executemany("DELETE FROM question_rows WHERE question_id = ?", [(q,) for q in stale])
+                self.conn.executemany("DELETE FROM questions WHERE id = ?", [(q,) for q in stale])
+            if len(picked) < num_questions:
+                return None
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE questions SET served_count = served_count + 1, last_served = ? WHERE id = ?",
+                [(now, qid) for qid, _ in picked],
+            )
+        quiz_list = [quiz for _, quiz in picked]
+        random.shuffle(quiz_list)
+        return quiz_list
+
+    def mark_served(self, source, difficulty, quiz_list):
+        """バンクの外から出題した問題（先に作っておいた問題など）を出題済みにする"""
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.executemany(
+                "UPDATE questions SET served_count = served_count + 1, last_served = ?"
+                " WHERE source = ? AND difficulty = ? AND question = ?",
+                [(now, source, difficulty, quiz["question"]) for quiz in quiz_list],
+            )
+
+    def window_done(self, source, difficulty, window_key):
+        """一括生成でこの区間を処理済みか"""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM build_windows WHERE source = ? AND difficulty = ? AND window_key = ?",
+                (source, difficulty, window_key),
+            ).fetchone() is not None
+
+    def mark_window(self, source, difficulty, window_key):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO build_windows(source, difficulty, window_key) VALUES (?, ?, ?)",
+                (source, difficulty, window_key),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+# ───────────────────────────────
+# ほぼ重複した問題の検出（MinHash / LSH）
+# ───────────────────────────────
+class QuestionFingerprints:
+    """
+    過去に作った問題の指紋（問題文の文字3-gramの MinHash）を保存しておき、
+    新しい問題が言い回しを変えただけの重複かどうかを調べる。
+    指紋を BANDS 個に区切った値で候補を引く（LSH）ので、数万問あっても1問の確認は一瞬で終わる。
+    確認（is_duplicate）と登録（add）は分かれていて、出題・保存した問題だけを登録する。
+    保存時はファイルロックを取って他のプロセスが保存した指紋とまとめる。
+    """
+    NUM_PERM = 32
+    BANDS = 8               # 1区切り 4 個。類似度 0.6 前後から候補に挙がる
+    _PRIME = (1 << 61) - 1
+    SEED = 20240601
+
+    def __init__(self, path=FINGERPRINT_FILE, threshold=NEAR_DUPLICATE_THRESHOLD):
+        self.path = path
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self.signatures = []  # 問題ごとの MinHash
+        self.answers = []     # 問題ごとの正規化した正解
+        self._bands = [{} for _ in range(self.BANDS)]  # 区切りの値 -> 問題番号のリスト
+        # 保存した指紋と比べられるよう、ハッシュの係数は固定の種の乱数で作る
+        rng = random.Random(self.SEED)
+        self._coeffs = [
+            (rng.randrange(1, self._PRIME), rng.randrange(0, self._PRIME)) for _ in range(self.NUM_PERM)
+        ]
+        self._unsaved = []    # まだファイルに書いていない (MinHash, 正解)
+        self._file_state = None  # 最後に読み書きしたときのファイルの (パス, サイズ, 更新時刻)
+        self._load()
+
+    @staticmethod
+    def shingles(text):
+        t = normalize_answer(text)
+        return {t[i:i + 3] for i in range(len(t) - 2)} or {t}
+
+    def signature(self, text):
+        hashes = [
+            int.from_bytes(hashlib.blake2b(g.encode("utf-8"), digest_size=8).digest(), "little")
+            for g in self.shingles(text)
+        ]
+        p = self._PRIME
+        return tuple(min((a * h + b) % p for h in hashes) for a, b in self._coeffs)
+
+    def _band_keys(self, sig):
+        r = self.NUM_PERM // self.BANDS
+        return [sig[k * r:(k + 1) * r] for k in range(self.BANDS)]
+
+    def _index(self, qid, sig):
+        for band, key in zip(self._bands, self._band_keys(sig)):
+            band.setdefault(key, []).append(qid)
+
+    def _similar(self, sig, other):
+        same = sum(1 for x, y in zip(sig, other) if x == y)
+        return same / self.NUM_PERM >= self.threshold
+
+    def _find(self, sig, answer):
+        """同じ区切りを持つ候補のうち、類似度が閾値以上で正解も同じものがあるか"""
+        candidates = set()
+        for band, key in zip(self._bands, self._band_keys(sig)):
+            candidates.update(band.get(key, ()))
+        return any(
+            self.answers[qid] == answer and self._similar(sig, self.signatures[qid])
+            for qid in candidates
+        )
+
+    def fingerprint(self, question, answer):
+        """問題の指紋 (MinHash, 正規化した正解)"""
+        return self.signature(question), normalize_answer(str(answer))
+
+    def is_duplicate(self, fingerprint, pending=()):
+        """
+        登録済みの問題、または pending（まだ登録していない指紋）とほぼ重複していれば True
+        """
+        sig, answer = fingerprint
+        if any(a == answer and self._similar(sig, other) for other, a in pending):
+            return True
+        with self._lock:
+            return self._find(sig, answer)
+
+    def _append(self, sig, answer):
+        self._index(len(self.signatures), sig)
+        self.signatures.append(sig)
+        self.answers.append(answer)
+
+    def add(self, fingerprints):
+        """出題・保存した問題の指紋を登録する"""
+        with self._lock:
+            for sig, answer in fingerprints:
+                if not self._find(sig, answer):
+                    self._append(sig, answer)
+                    self._unsaved.append((sig, answer))
+
+    def _read(self):
+        try:
+            state = file_signature(self.path)
+            with open(self.path, "rb") as f:
+                data = pickle.load(f)
+            self._file_state = state
+            return data["signatures"], data["answers"]
+        except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError):
+            return None
+
+    def _changed_on_disk(self):
+        """最後に読み書きした後で、他のプロセスがファイルを書き換えたか"""
+        try:
+            return file_signature(self.path) != self._file_state
+        except OSError:
+            return self._file_state is not None
+
+    def _load(self):
+        data = self._read()
+        if data is None:
+            return
+        self.signatures, self.answers = data
+        for qid, sig in enumerate(self.signatures):
+            self._index(qid, sig)
+
+    def save(self):
+        """
+        ファイルロックの中で最新のファイルを読み直し、まだ書いていない指紋を足して書き戻す
+        （他のプロセスが保存した指紋を上書きしない）
+        最後に読み書きした後でファイルが変わっていなければ、読み直さずにそのまま書き出す
+        """
+        with self._lock:
+            if not self._unsaved:
+                return
+            unsaved, self._unsaved = self._unsaved, []
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            lock = FileLock(self.path + ".lock")
+            try:
+                with lock:
+                    merge = self._changed_on_disk()
+                    signatures, answers = (self._read() if merge else None) or ([], [])
+                    with self._lock:
+                        if merge:
+                            # 他のプロセスの指紋も取り込んでから、自分の分を足す
+                            self.signatures, self.answers = list(signatures), list(answers)
+                            self._bands = [{} for _ in range(self.BANDS)]
+                            for qid, sig in enumerate(self.signatures):
+                                self._index(qid, sig)
+                            for sig, answer in unsaved + self._unsaved:
+                                if not self._find(sig, answer):
+                                    self._append(sig, answer)
+                        data = {"signatures": list(self.signatures), "answers": list(self.answers)}
+                    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".fingerprints-")
+                    with os.fdopen(fd, "wb") as f:
+                        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+                    os.replace(tmp, self.path)
+                    self._file_state = file_signature(self.path)
+            finally:
+                lock.close()
+        except OSError as e:
+            print(f"問題の指紋を保存できませんでした: {e}")
+
+
+# ───────────────────────────────
+# 送るデータのトークン予算
+# ───────────────────────────────
+def estimate_tokens(text):
+    """
+    トークン数の概算（トークナイザを使わない）
+    漢字・かなは1文字およそ1トークン、英数字や記号は4文字でおよそ1トークンとして数える
+    """
+    wide = sum(1 for c in text if ord(c) >= 0x3000)
+    return wide + (len(text) - wide + 3) // 4
+
+
+class TokenBudgeter:
+    """
+    行ごとの推定トークン数を覚えておき、予算に収まるだけの行を学習データとして選ぶ。
+    予算は「学習データの上限」「文脈長から指示と出力の分を引いた残り」「待ち時間の目標」の最小値。
+    """
+    DEFAULT_ROW_TOKENS = 40  # まだ1行も見ていないときの1行の見込み
+
+    def __init__(self, prompt_budget=PROMPT_TOKEN_BUDGET, num_ctx=NUM_CTX,
+                 latency_target=PROMPT_LATENCY_TARGET, eval_rate=PROMPT_EVAL_TOKENS_PER_SEC):
+        self.prompt_budget = prompt_budget
+        self.num_ctx = num_ctx
+        self.latency_target = latency_target
+        self.eval_rate = eval_rate
+        self._row_tokens = {}  # 行の内容ハッシュ -> 推定トークン数
+        self._total = 0        # 覚えている行の推定トークン数の合計（平均を出すため）
+
+    def row_tokens(self, key, line):
+        tokens = self._row_tokens.get(key)
+        if tokens is None:
+            tokens = self._row_tokens[key] = estimate_tokens(line)
+            self._total += tokens
+        return tokens
+
+    @property
+    def average_row_tokens(self):
+        if not self._row_tokens:
+            return self.DEFAULT_ROW_TOKENS
+        return self._total / len(self._row_tokens)
+
+    def data_budget(self, fixed_tokens, output_tokens):
+        """学習データに使えるトークン数"""
+        return max(0, min(
+            self.prompt_budget,
+            self.num_ctx - fixed_tokens - output_tokens,
+            int(self.latency_target * self.eval_rate),
+        ))
+
+    def row_count(self, budget):
+        """予算から、抽出する行数の見込み（平均より少し長めに見積もる）"""
+        count = int(budget / (self.average_row_tokens * 1.2))
+        return max(BUDGET_MIN_ROWS, min(BUDGET_MAX_ROWS, count))
+
+    def pack(self, rows, budget):
+        """(内容ハッシュ, CSV1行) のリストを先頭から予算に収まるだけ選び、(選んだ行, 推定トークン数) を返す"""
+        packed, used = [], 0
+        for key, line in rows:
+            tokens = self.row_tokens(key, line)
+            if packed and used + tokens > budget:
+                continue  # 長すぎる行は飛ばし、後ろの短い行で予算を埋める
+            packed.append((key, line))
+            used += tokens
+        return packed, used
+
+
+# ───────────────────────────────
+# 生成速度の計測
+# ───────────────────────────────
+class ThroughputStats:
+    """
+    モデルごとに、出力トークン/秒と1問あたりの出力トークン数の移動平均を記録する。
+    次回の起動でも使えるようJSONに保存する。
+    """
+    ALPHA = 0.3  # 新しい計測値の重み
+
+    def __init__(self, path=THROUGHPUT_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path, encoding="utf-8") as f:
+                self._stats = json.load(f)
+        except (OSError, ValueError):
+            self._stats = {}
+
+    def record(self, model, prompt_tokens, completion_tokens, seconds, questions=0):
+        """1回の問い合わせの使用トークン数と所要時間を記録する"""
+        if seconds <= 0 or completion_tokens <= 0:
+            return
+        with self._lock:
+            entry = self._stats.get(model)
+            tps = completion_tokens / seconds
+            tpq = completion_tokens / questions if questions else None
+            if entry is None:
+                entry = self._stats[model] = {
+                    "tokens_per_sec": tps,
+                    "tokens_per_question": tpq or OUTPUT_TOKENS_PER_QUESTION,
+                    "samples": 0,
+                }
+            else:
+                entry["tokens_per_sec"] += self.ALPHA * (tps - entry["tokens_per_sec"])
+                if tpq:
+                    entry["tokens_per_question"] += self.ALPHA * (tpq - entry["tokens_per_question"])
+            entry["samples"] += 1
+            entry["last_prompt_tokens"] = prompt_tokens
+            entry["last_seconds"] = round(seconds, 2)
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix=".throughput-")
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
+                    json.dump(self._stats, f)
+                os.replace(tmp, self.path)
+            except OSError as e:
+                print(f"生成速度を保存できませんでした: {e}")
+
+    def get(self, model):
+        """{"tokens_per_sec", "tokens_per_question", "samples", ...}（未計測なら None）"""
+        with self._lock:
+            entry = self._stats.get(model)
+            return dict(entry) if entry else None
+
+
+# ───────────────────────────────
+# AIサーバーの振り分け
+# ───────────────────────────────
+class LLMEndpoint:
+    """AIサーバー1台と、そこで使うモデルの設定・状態"""
+    def __init__(self, name, base_url, model, difficulties=None, api_key=API_KEY, http_client=None,
+                 extra_body=None):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.difficulties = set(difficulties) if difficulties else None  # None なら全難易度
+        # 問い合わせに追加する項目（None なら標準の項目だけを送る）
+        self.extra_body = dict(extra_body) if extra_body is not None else None
+        self.client = OpenAI(base_url=self.base_url, api_key=api_key, http_client=http_client)
+        self.api_key = api_key
+        self.healthy = None     # None は未確認（使ってよい）
+        self.latency = None     # 応答確認にかかった秒数（移動平均）
+        self.last_error = None
+
+    @property
+    def key(self):
+        """生成速度の記録に使う名前"""
+        return f"{self.name}:{self.model}"
+
+    @property
+    def ollama_url(self):
+        """Ollama のネイティブAPIのURL"""
+        return self.base_url.rsplit("/v1", 1)[0]
+
+    def allows(self, difficulty):
+        return self.difficulties is None or difficulty is None or difficulty in self.difficulties
+
+
+class EndpointPool:
+    """
+    複数のAIサーバーを持ち、バックグラウンドで応答を確認しながら、
+    難易度ごとに使えるサーバーのうち一番早く終わりそうなものを選ぶ。
+    """
+    ALPHA = 0.3
+
+    def __init__(self, configs, http_client, throughput):
+        self.http_client = http_client
+        self.throughput = throughput
+        self.endpoints = [LLMEndpoint(http_client=http_client, **config) for config in configs]
+        if not self.endpoints:
+            raise ValueError("AIサーバーが1つも設定されていません")
+        self._lock = threading.Lock()
+        self._started = False
+
+    def probe(self, endpoint):
+        """サーバーのモデル一覧（/models）を取得して、応答するか・どれくらいで返るかを調べる"""
+        started = time.monotonic()
+        try:
+            response = self.http_client.get(
+                f"{endpoint.base_url}/models",
+                headers={"Authorization": f"Bearer {endpoint.api_key}"},
+                timeout=HEALTH_CHECK_TIMEOUT,
+            )
+            response.raise_for_status()
+        except Exception as e:
+            self.report_failure(endpoint, e)
+            return False
+        elapsed = time.monotonic() - started
+        with self._lock:
+            endpoint.healthy = True
+            endpoint.last_error = None
+            if endpoint.latency is None:
+                endpoint.latency = elapsed
+            else:
+                endpoint.latency += self.ALPHA * (elapsed - endpoint.latency)
+        return True
+
+    def probe_all(self):
+        for endpoint in self.endpoints:
+            self.probe(endpoint)
+
+    def start(self, interval=HEALTH_CHECK_INTERVAL):
+        """応答確認をバックグラウンドで定期的に行う（2回目以降の呼び出しは何もしない）"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+
+        def loop():
+            while True:
+                self.probe_all()
+                time.sleep(interval)
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def report_failure(self, endpoint, error):
+        with self._lock:
+            if endpoint.healthy is not False:
+                print(f"AIサーバー {endpoint.name} に接続できません: {error}")
+            endpoint.healthy = False
+            endpoint.last_error = str(error)
+
+    def report_success(self, endpoint):
+        with self._lock:
+            endpoint.healthy = True
+
+    def expected_seconds(self, endpoint, num_questions=10):
+        """
+        num_questions 問の生成にかかる見込みの秒数
+        生成速度をまだ計測していないサーバーは応答確認の時間だけで見積もり、先に一度使って計測する
+        """
+        stats = self.throughput.get(endpoint.key)
+        seconds = endpoint.latency or 0.0
+        if stats is None:
+            return seconds
+        return seconds + num_questions * stats["tokens_per_question"] / stats["tokens_per_sec"]
+
+    def choose(self, difficulty=None, exclude=()):
+        """
+        この難易度に使えるサーバーのうち、応答していて一番早く終わりそうなものを返す
+        全部応答していなければ、使えるサーバーの中から選んで試す
+        """
+        candidates = [e for e in self.endpoints if e.allows(difficulty) and e not in exclude]
+        if not candidates:
+            raise RuntimeError(f"難易度「{difficulty}」に使えるAIサーバーがありません")
+        healthy = [e for e in candidates if e.healthy is not False] or candidates
+        return min(healthy, key=self.expected_seconds)
+
+
+# ───────────────────────────────
+# AI出力の解析
+# ───────────────────────────────
+class IncrementalQuizParser:
+    """
+    AIの出力を少しずつ受け取り、完成した { ... } オブジェクトを順に取り出すパーサ。
+    文字列中の括弧やエスケープを考慮しながら1文字ずつ1回だけ走査する。
+    {"questions": [{...}, ...]} のように包まれていれば、中の問題のオブジェクトを取り出す。
+    """
+    def __init__(self):
+        self._buf = []        # 読みかけのオブジェクトの文字
+        self._depth = 0       # { } の深さ
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, text):
+        """新しく届いた文字列を渡し、完成したオブジェクト（dict）のリストを返す"""
+        done = []
+        for c in text:
+            if self._depth == 0:
+                # オブジェクトの外側（配列の括弧や説明文）は読み飛ばす
+                if c == "{":
+                    self._depth = 1
+                    self._buf = [c]
+                continue
+
+            self._buf.append(c)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads("".join(self._buf))
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        done.extend(self.unwrap(obj))
+                    self._buf = []
+        return done
+
+    @classmethod
+    def unwrap(cls, obj):
+        """問題のオブジェクトならそのまま、そうでなければ中に入っている問題のオブジェクトを返す"""
+        if not isinstance(obj, (dict, list)):
+            return []
+        if isinstance(obj, dict):
+            if "question" in obj:
+                return [obj]
+            obj = obj.values()
+        return [quiz for value in obj for quiz in cls.unwrap(value)]
+
+
+def is_valid_quiz(difficulty, quiz):
+    """
+    問題として表示できる形式かどうか
+    初級は選択肢が異なる3つの文字列で、その中に正解があること
+    """
+    if not isinstance(quiz, dict):
+        return False
+    question, answer = quiz.get("question"), quiz.get("answer")
+    if not isinstance(question, str) or not question.strip():
+        return False
+    if not isinstance(answer, str) or not answer.strip():
+        return False
+    if difficulty == "初級":
+        choices = quiz.get("choices")
+        return (
+            isinstance(choices, list) and len(choices) == 3
+            and all(isinstance(c, str) and c.strip() for c in choices)
+            and len(set(choices)) == 3 and answer in choices
+        )
+    return True
+
+
+def quiz_json_schema(difficulty):
+    """サーバーに出力を制限させるための、問題の配列のJSONスキーマ"""
+    item = {
+        "type": "object",
+        "properties": {"question": {"type": "string"}, "answer": {"type": "string"}},
+        "required": ["question", "answer"],
+    }
+    if difficulty == "初級":
+        item["properties"]["choices"] = {
+            "type": "array", "items": {"type": "string"}, "minItems": 3, "maxItems": 3,
+        }
+        item["required"] = ["question", "choices", "answer"]
+    return {"type": "array", "items": item}
+
+
 # ───────────────────────────────
 # ① ロジッククラス（問題生成・正誤判定・履歴管理）
 # ───────────────────────────────
@@ -41,174 +1902,1317 @@ class QuizLogic:
     """
     AIとの通信やクイズの正誤判定、Excel読み込みを担当するクラス
     """
-    def __init__(self):
-        self.client = OpenAI(
-            base_url=API_BASE_URL,
-            api_key=API_KEY,
-            http_client=httpx.Client(verify=False, timeout=120.0),
+    def __init__(self, max_connections=HTTP_MAX_CONNECTIONS, data_dir=None):
+        # 出題履歴・問題バンクなどの記録の置き場所（省略時は COVERAGE_DIR と各 *_FILE の設定どおり）
+        self.data_dir = data_dir
+        # 分割リクエストや問題の補充で同時に複数の接続を使うので、接続をプールして使い回す
+        # 同時に送るリクエスト数がこれを超えると、超えた分は接続が空くまで待たされる
+        self.max_connections = max_connections
+        self.http_client = httpx.Client(
+            verify=False,
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
         )
-        # 使用済みデータの行番号を記録するリスト（データ被り防止用）
-        self.used_indices = []
+        # AIの出力を逐次受け取り、1問ずつ取り出すか
+        self.stream_responses = STREAM_RESPONSES
+        # JSONスキーマに沿った出力をサーバーに求めるか
+        self.structured_output = STRUCTURED_OUTPUT
+        # 難易度ごとにサーバーのスロットを固定するか
+        self.pin_slots = PIN_SLOTS
+        # 送る学習データの量をトークン数で決める（None なら従来どおり30行）
+        self.token_budgeter = TokenBudgeter() if TOKEN_BUDGET else None
+        self.last_budget_report = None  # 直近の抽出の行数・推定トークン数（調整用）
+        # 問い合わせごとの生成速度の記録と、それに合わせた問題数の調整
+        self.throughput = ThroughputStats(self._data_file(THROUGHPUT_FILE))
+        # AIサーバーの一覧。難易度ごとに、応答していて一番速いサーバーへ振り分ける
+        self.endpoints = EndpointPool(LLM_ENDPOINTS, self.http_client, self.throughput)
+        # 応答が遅いときに同じ依頼を追加で送る（ヘッジ）設定と、その集計
+        self.hedge_requests = HEDGE_REQUESTS
+        self.hedge_stats = {"requests": 0, "hedged": 0, "primary_wins": 0, "hedge_wins": 0, "failed": 0}
+        self._latencies = {}  # 難易度 -> 最近の1問目までの時間（秒）
+        self._hedge_lock = threading.Lock()
+        self.adaptive_batch = ADAPTIVE_BATCH
+        self.target_ready_seconds = TARGET_READY_SECONDS
+        # 多めに頼む割合と、不足分を追加で頼むときの時間の上限
+        self.overgenerate_ratio = OVERGENERATE_RATIO
+        self.top_up_budget = TOP_UP_BUDGET_SECONDS
+        # 1回の生成を分割して同時に送るリクエスト数
+        self.num_shards = max(1, NUM_SHARDS)
+        # 過去の問題とほぼ重複した問題を除くための指紋
+        self.fingerprints = QuestionFingerprints(self._data_file(FINGERPRINT_FILE)) if NEAR_DUPLICATE_CHECK else None
+        # 生成した問題を貯めておく問題バンク（開けなければ使わない）
+        self.question_bank = None
+        if QUESTION_BANK:
+            try:
+                self.question_bank = QuestionBank(self._data_file(QUESTION_BANK_FILE))
+            except (OSError, sqlite3.Error) as e:
+                print(f"問題バンクを開けませんでした: {e}")
+        # 使用済みデータの行番号を管理するサンプラー（データ被り防止用）
+        # 共有ファイルが使えないときはメモリ上の RowSampler を使う
+        self.sampler = self._memory_sampler = RowSampler()
+        self.persistent_coverage = PERSISTENT_COVERAGE
+        self.coverage_dir = data_dir or COVERAGE_DIR
+        self.handoff_file = self._data_file(HANDOFF_FILE)
+        self._coverage = {}
+        self._memory_key = None
+        # フォルダごとの科目カタログ
+        self._catalogs = {}
+        # キーワード検索用インデックス（サイドカーのパスごと）
+        self._topic_indexes = {}
+        # 苦手度と、それを反映した重み付きサンプラー（ワークブック・シートごと）
+        self.row_weights = RowWeights(self._data_file(WEIGHTS_FILE))
+        self._weighted = {}
+        # 苦手度は回答のたびに画面側から更新するので、行の抽出とは別のロックで守る
+        self._weights_lock = threading.Lock()
+        # 直近に抽出した行の (内容ハッシュ, CSV1行)。問題と元の行を結び付けるのに使う
+        self.last_rows = []
+        # 内容の近い行を探すための n-gram インデックス（ワークブック・シートごと）
+        self._ngram_indexes = {}
+        # 生成は別スレッドで行うため、行の抽出や苦手度の更新はこのロックで守る
+        self._lock = threading.Lock()
+        # 解析済みExcelのキャッシュ（更新時刻が変われば自動で再解析）
+        self.workbook_cache = WorkbookCache()
+        self.sampling_mode = SAMPLING_MODE
+        # 先に作っておいた次の回の問題 (難易度, 出題範囲) -> [(Excelの状態, 問題リスト), ...]
+        self.prefetch_depth = PREFETCH_DEPTH
+        self._prefetched = {}
+        self._prefetching = set()
+        # 生成が終わるのを待てるよう Condition にしておく（wait_prefetch）
+        self._prefetch_lock = threading.Condition()
+
+    def _data_file(self, path):
+        """記録用のファイルのパス（data_dir を指定したときは、同じ名前でその中に置く）"""
+        return path if self.data_dir is None else os.path.join(self.data_dir, os.path.basename(path))
+
+    @property
+    def used_indices(self):
+        """使用済みデータの行番号のリスト"""
+        return self.sampler.used_indices
 
     def reset_history(self):
         """履歴をリセットする"""
-        self.used_indices = []
+        self.sampler.reset()
 
-    def load_random_excel_data(self, filepath, num_samples=20):
+    def _select_sampler(self, content_hash, total_rows=0, diff=None):
+        """
+        ワークブックの内容に対応するサンプラーを self.sampler に設定する
+        diff（RowDiff）があれば、前回の版の出題履歴を行の内容で引き継ぐ
+        """
+        if self.persistent_coverage:
+            sampler = self._coverage.get(content_hash)
+            if sampler is None:
+                try:
+                    sampler = SharedCoverageSampler(content_hash, total_rows, self.coverage_dir)
+                except OSError as e:
+                    print(f"出題履歴ファイルを開けませんでした: {e}")
+                    self.persistent_coverage = False
+                else:
+                    self._coverage[content_hash] = sampler
+                    if diff is not None and not sampler.used_count:
+                        self._carry_history(diff, self._old_coverage(diff.old_hash), sampler, total_rows)
+                        self._remove_coverage(diff.old_hash)
+            if sampler is not None:
+                self.sampler = sampler
+                return sampler
+
+        if diff is not None and self._memory_key == diff.old_hash:
+            self._carry_history(diff, self._memory_sampler.used_indices, self._memory_sampler, total_rows)
+        self._memory_key = content_hash
+        self.sampler = self._memory_sampler
+        return self.sampler
+
+    def _old_coverage(self, content_hash):
+        """前回の版の出題履歴（共有ビットマップ）を読み出す"""
+        old = self._coverage.pop(content_hash, None)
+        if old is None:
+            if not os.path.exists(os.path.join(self.coverage_dir, f"{content_hash}.bitmap")):
+                return []
+            try:
+                old = SharedCoverageSampler(content_hash, directory=self.coverage_dir)
+            except OSError:
+                return []
+        used = old.used_indices
+        old.close()
+        return used
+
+    def _remove_coverage(self, content_hash):
+        """引き継ぎを終えた前回の版の出題履歴ファイルを消す（使用中などで消せなければ残す）"""
+        path = os.path.join(self.coverage_dir, f"{content_hash}.bitmap")
+        for name in (path, path + ".lock"):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _carry_history(diff, old_used, sampler, total_rows):
+        """変更されていない行の出題履歴だけを新しい行番号に付け替える"""
+        sampler.resize(total_rows)
+        sampler.reset()
+        sampler.mark(j for j in map(diff.map_old, old_used) if j is not None)
+
+    def catalog(self, directory=CORPUS_DIR, scan=True):
+        """
+        フォルダの科目カタログを返す（変更されたワークブックだけ読み直す）
+        scan=False なら走査せず、前回保存した目録を返す（起動直後の表示用）
+        """
+        catalog = self._catalogs.get(directory)
+        if catalog is None:
+            catalog = self._catalogs[directory] = CorpusCatalog(directory, self.workbook_cache)
+            if not scan:
+                return catalog.load_index()
+        return catalog.scan() if scan else catalog
+
+    def load_random_excel_data(self, filepath, num_samples=20, mode=None, sheet=0, keywords=None):
         """
         Excelファイルを読み込み、まだ使っていない行からランダムにデータを抽出
+        mode を省略した場合は self.sampling_mode の方式を使う
+        filepath にフォルダを指定すると、カタログの全科目から抽出する
+        keywords を指定すると、キーワードを含む行だけから抽出する
         """
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"ファイルが見つかりません: {filepath}")
+        self.last_rows = []
+
+        if keywords:
+            try:
+                return self.load_keyword_data(filepath, num_samples, keywords, sheet)
+            except Exception as e:
+                raise RuntimeError(f"Excel読み込みエラー: {e}")
+
+        if os.path.isdir(filepath):
+            try:
+                return self.load_catalog_data(filepath, num_samples)
+            except Exception as e:
+                raise RuntimeError(f"Excel読み込みエラー: {e}")
+
+        mode = mode or self.sampling_mode
+        if mode == "stream":
+            try:
+                return self.stream_random_excel_data(filepath, num_samples, sheet)
+            except Exception as e:
+                raise RuntimeError(f"Excel読み込みエラー: {e}")
+        if mode == "weighted":
+            try:
+                return self.load_weighted_data(filepath, num_samples, sheet)
+            except Exception as e:
+                raise RuntimeError(f"Excel読み込みエラー: {e}")
+        if mode == "cluster":
+            try:
+                return self.load_cluster_data(filepath, num_samples, sheet)
+            except Exception as e:
+                raise RuntimeError(f"Excel読み込みエラー: {e}")
 
         try:
-            df = pd.read_excel(filepath, header=None)
+            book = self.workbook_cache.load(filepath, sheet)
             
-            if df.empty:
+            if len(book) == 0:
                 return "データがありません。"
 
-            total_rows = len(df)
-            
-            # まだ使っていない行のインデックスを取得
-            available_indices = [i for i in range(total_rows) if i not in self.used_indices]
-            
-            # もし未使用データが足りなければ、履歴をリセットして全データから選ぶ
-            if len(available_indices) < num_samples:
-                print("データが一巡しました。履歴をリセットして再利用します。")
-                self.used_indices = []
-                available_indices = list(range(total_rows))
-
-            # 利用可能な行からランダムにインデックスを選択
-            current_sample_size = min(len(available_indices), num_samples)
-            selected_indices = random.sample(available_indices, current_sample_size)
-            
-            # 選んだインデックスを使用済みリストに追加
-            self.used_indices.extend(selected_indices)
+            # まだ使っていない行からランダムに選択（一巡したら履歴をリセット）
+            sampler = self._select_sampler(book.content_hash, len(book), book.diff)
+            sampler.resize(len(book))
+            selected_indices = sampler.draw(num_samples)
 
-            # 選んだ行のデータを抽出
-            sampled_df = df.iloc[selected_indices]
-            
             print(f"使用した行番号: {selected_indices}") # デバッグ用
-            return sampled_df.to_csv(index=False, header=False)
+            # 選んだ行のデータを抽出
+            self.last_rows = book.selection(selected_indices)
+            return book.to_csv(selected_indices)
 
         except Exception as e:
             raise RuntimeError(f"Excel読み込みエラー: {e}")
 
-    def generate_quiz_batch(self, difficulty, filename, num_questions=10):
+    def load_catalog_data(self, directory, num_samples=20):
+        """カタログの全科目を通した行番号から、まだ使っていない行を抽出する"""
+        catalog = self.catalog(directory)
+        total_rows = catalog.total_rows
+        if total_rows == 0:
+            return "データがありません。"
+
+        sampler = self._select_sampler(catalog.content_hash, total_rows)
+        sampler.resize(total_rows)
+        selected_indices = sampler.draw(num_samples)
+
+        print(f"使用した行番号: {selected_indices}") # デバッグ用
+        self.last_rows = catalog.selection(selected_indices)
+        return catalog.to_csv(selected_indices)
+
+    def load_weighted_data(self, filepath, num_samples=20, sheet=0):
+        """苦手度（重み）に比例して行を抽出する。間違えた行ほど出やすい"""
+        book = self.workbook_cache.load(filepath, sheet)
+        if len(book) == 0:
+            return "データがありません。"
+
+        # (内容ハッシュ, サンプラー, 内容ハッシュ -> 行番号)。Excelが変わったら作り直す
+        with self._weights_lock:
+            cached = self._weighted.get((book.signature[0], sheet))
+            if cached is None or cached[0] != book.content_hash:
+                tree = FenwickSampler(self.row_weights.get(book.row_key(i)) for i in range(len(book)))
+                cached = (book.content_hash, tree, book.rows_by_key())
+                self._weighted[(book.signature[0], sheet)] = cached
+            selected_indices = cached[1].sample(num_samples)
+
+        # 通常の抽出でも被らないよう、使用済みにしておく
+        sampler = self._select_sampler(book.content_hash, len(book), book.diff)
+        sampler.resize(len(book))
+        sampler.mark(selected_indices)
+
+        print(f"使用した行番号: {selected_indices}") # デバッグ用
+        self.last_rows = book.selection(selected_indices)
+        return book.to_csv(selected_indices)
+
+    def load_cluster_data(self, filepath, num_samples=15, sheet=0):
         """
-        指定されたExcelファイルの内容に基づいて、指定数分の問題を【一括生成】する
+        まだ使っていない行を1つ起点に選び、内容の近い行を num_samples 行まで集める。
+        関連する少数の行だけを送るので、プロンプトが短くなり応答が速くなる。
+        """
+        book = self.workbook_cache.load(filepath, sheet)
+        if len(book) == 0:
+            return "データがありません。"
+
+        key = (book.signature[0], sheet)
+        index = self._ngram_indexes.get(key)
+        if index is None or index.content_hash != book.content_hash:
+            index = NgramIndex.load_or_build(book, sidecar_path(filepath, NGRAM_SUFFIX, sheet))
+            self._ngram_indexes[key] = index
+
+        sampler = self._select_sampler(book.content_hash, len(book), book.diff)
+        sampler.resize(len(book))
+        seed = sampler.draw(1)
+        selected_indices = index.cluster(seed[0], num_samples, sampler.used_snapshot()) if seed else []
+        if len(selected_indices) < num_samples:
+            # 近い行が足りなければ、答えの語が重ならない未使用の行をランダムに補う
+            chosen = set(selected_indices)
+            terms = {t for i in selected_indices for t in index.terms[i]}
+            is_used = sampler.used_snapshot()
+            rest = [i for i in range(len(book)) if i not in chosen and not is_used(i)]
+            random.shuffle(rest)
+            for i in rest:
+                if len(selected_indices) >= num_samples:
+                    break
+                if not terms.intersection(index.terms[i]):
+                    selected_indices.append(i)
+                    chosen.add(i)
+                    terms.update(index.terms[i])
+        if len(selected_indices) < num_samples:
+            # それでも足りなければ（答えの語の種類が少ないシート）、重なりを許して補う
+            chosen = set(selected_indices)
+            extra = [i for i in sampler.draw(num_samples - len(selected_indices)) if i not in chosen]
+            selected_indices += extra
+        sampler.mark(selected_indices)
+
+        print(f"使用した行番号: {selected_indices}") # デバッグ用
+        self.last_rows = book.selection(selected_indices)
+        return book.to_csv(selected_indices)
+
+    def record_result(self, quiz, is_correct):
+        """回答結果を、問題の元になった行の苦手度に反映する"""
+        keys = quiz.get("source_rows") or []
+        if not keys:
+            return
+        with self._weights_lock:
+            for key in keys:
+                weight = self.row_weights.update(key, is_correct)
+                # 読み込み済みの重み付きサンプラーにも O(log n) で反映する
+                for _, tree, rows_by_key in self._weighted.values():
+                    for i in rows_by_key.get(key, []):
+                        tree.update(i, weight)
+        # ファイルへの保存は別スレッドで行い、回答直後の画面を待たせない
+        threading.Thread(target=self._save_weights).start()
+
+    def _save_weights(self):
+        """苦手度を保存する（後から保存するスレッドほど新しい内容を書く）"""
+        with self._weights_lock:
+            self.row_weights.save()
+
+    @staticmethod
+    def attach_source_rows(quiz_list, rows):
+        """正解の語を含む行を、その問題の元の行として記録する"""
+        normalized = [(key, normalize_answer(text)) for key, text in rows]
+        for quiz in quiz_list:
+            answer = normalize_answer(str(quiz.get("answer", "")))
+            if answer:
+                quiz["source_rows"] = [key for key, text in normalized if answer in text]
+
+    def topic_index(self, filepath, sheet=0):
+        """ワークブックの全文検索インデックスを、内容と同期してから返す"""
+        book = self.workbook_cache.load(filepath, sheet)
+        path = sidecar_path(filepath, FTS_SUFFIX, sheet)
+        index = self._topic_indexes.get(path)
+        if index is None:
+            index = self._topic_indexes[path] = TopicIndex(path)
+        index.sync(book)
+        return index, book
+
+    def load_keyword_data(self, filepath, num_samples, keywords, sheet=0):
+        """
+        全文検索インデックスでキーワードに一致する行を探し、その中から抽出する
+        （一致した行のうち未使用のものを優先する）
+        """
+        diff = None
+        if os.path.isdir(filepath):
+            catalog = self.catalog(filepath)
+            hits = []
+            for entry in catalog.entries:
+                index, book = self.topic_index(entry["path"], entry["sheet"])
+                hits.extend(entry["offset"] + i for i in index.search(keywords, book))
+            key, total_rows, source = catalog.content_hash, catalog.total_rows, catalog
+        else:
+            index, book = self.topic_index(filepath, sheet)
+            hits = index.search(keywords, book)
+            key, total_rows, source, diff = book.content_hash, len(book), book, book.diff
+
+        print(f"キーワード「{keywords}」に一致した行: {len(hits)}件")
+        if not hits:
+            return "データがありません。"
+
+        sampler = self._select_sampler(key, total_rows, diff)
+        sampler.resize(total_rows)
+        is_used = sampler.used_snapshot()
+        unused = [i for i in hits if not is_used(i)]
+        selected_indices = random.sample(unused, min(num_samples, len(unused)))
+        if len(selected_indices) < num_samples:
+            # 一致した行を使い切ったら、使用済みの行でも補う
+            chosen = set(selected_indices)
+            rest = [i for i in hits if i not in chosen]
+            selected_indices += random.sample(rest, min(num_samples - len(selected_indices), len(rest)))
+        sampler.mark(selected_indices)
+
+        print(f"使用した行番号: {selected_indices}") # デバッグ用
+        self.last_rows = source.selection(selected_indices)
+        return source.to_csv(selected_indices)
+
+    def stream_random_excel_data(self, filepath, num_samples=20, sheet=0):
+        """
+        DataFrameを作らずに、行を1つずつ読みながらリザーバサンプリングで抽出する。
+        保持するのは選ばれた num_samples 行だけなので、シートの大きさに依存しない。
+        """
+        # 行数は最初から渡しておき、抽出後に resize で作り直さずに済ませる
+        self._select_sampler(workbook_content_hash(filepath, sheet), excel_row_count(filepath, sheet))
+
+        def reservoir(skip_used):
+            picked = []   # (行番号, 値)
+            seen = 0      # 候補になった行数
+            total = 0     # 末尾の空行を除いた行数（キャッシュの行数と揃える）
+            is_used = self.sampler.used_snapshot() if skip_used else None
+            for i, values in enumerate(iter_excel_rows(filepath, sheet)):
+                # 空行は候補にしない（行番号はキャッシュと揃えるため数える）
+                if all(v is None for v in values):
+                    continue
+                total = i + 1
+                if skip_used and is_used(i):
+                    continue
+                seen += 1
+                if len(picked) < num_samples:
+                    picked.append((i, values))
+                else:
+                    j = random.randrange(seen)
+                    if j < num_samples:
+                        picked[j] = (i, values)
+            return picked, seen, total
+
+        picked, available, total_rows = reservoir(skip_used=True)
+
+        # 未使用データが足りなければ、履歴をリセットしてもう一度全体から選ぶ
+        if available < num_samples and self.sampler.used_count:
+            print("データが一巡しました。履歴をリセットして再利用します。")
+            self.sampler.reset()
+            picked, available, total_rows = reservoir(skip_used=False)
+
+        if not picked:
+            return "データがありません。"
+
+        random.shuffle(picked)
+        selected_indices = [i for i, _ in picked]
+        self.sampler.resize(total_rows)
+        self.sampler.mark(selected_indices)
+
+        print(f"使用した行番号: {selected_indices}") # デバッグ用
+        lines = [format_csv_row(values) for _, values in picked]
+        self.last_rows = [
+            (row_content_hash([cell_text(v) for v in values]).hex(), line)
+            for (_, values), line in zip(picked, lines)
+        ]
+        return "".join(lines)
+
+    def _load_batch_rows(self, filename, num_questions, sheet=0, keywords=None, difficulty=None):
+        """
+        1回の生成に使う行を抽出し、(CSV文字列, 抽出した行の (内容ハッシュ, CSV1行)) を返す
+        トークン予算が有効なら、予算に見合う行数を抽出し、収まる行だけを返す
         """
         # Excelデータを取得（履歴管理機能付き）
-        try:
-            data_content = self.load_random_excel_data(filename, num_samples=30)
-        except Exception as e:
-            print(e)
-            return None
+        # "cluster" では問題数に見合った少数の関連する行だけを送る
+        num_samples = 30
+        budget = None
+        if self.sampling_mode == "cluster" and not keywords and not os.path.isdir(filename):
+            num_samples = math.ceil(num_questions * CLUSTER_ROWS_PER_QUESTION)
+        elif self.token_budgeter is not None:
+            budget = self._data_budget(difficulty, num_questions)
+            num_samples = self.token_budgeter.row_count(budget)
+        with self._lock:
+            data_content = self.load_random_excel_data(
+                filename, num_samples=num_samples, sheet=sheet, keywords=keywords
+            )
+            rows = self.last_rows
+            if budget is None or not rows:
+                return data_content, rows
+            packed, tokens = self.token_budgeter.pack(rows, budget)
+        self.last_budget_report = {
+            "budget": budget,
+            "sampled_rows": len(rows),
+            "rows": len(packed),
+            "tokens": tokens,
+            "row_keys": [key for key, _ in packed],
+        }
+        print(f"学習データ: {len(packed)}/{len(rows)}行, 推定 {tokens}トークン（予算 {budget}）")
+        return "".join(line for _, line in packed), packed
+
+    def _data_budget(self, difficulty, num_questions):
+        """指示と出力の分を除いた、学習データに使えるトークン数"""
+        fixed = 0
+        if difficulty:
+            fixed = sum(
+                estimate_tokens(m["content"]) for m in self.build_prompt(difficulty, "", num_questions)
+            )
+        output = self._requested_count(num_questions) * OUTPUT_TOKENS_PER_QUESTION
+        return self.token_budgeter.data_budget(fixed, output)
 
-        # プロンプト作成
-        base_instruction = f"""
+    def system_prompt(self, difficulty):
+        """
+        難易度ごとに固定の指示（システムメッセージ）
+        毎回まったく同じ文字列なので、サーバーは前回の処理結果（KVキャッシュ）を再利用でき、
+        新しく処理するのは後ろに付く学習データの部分だけになる
+        """
+        base_instruction = """
         あなたはプロのクイズ作家です。
-        以下の【学習データ】の内容**のみ**に基づいて、多様なクイズを作成してください。
+        ユーザーが渡す【学習データ】の内容**のみ**に基づいて、多様なクイズを作成してください。
         （前回とは違う箇所のデータを使用しています）
         
         ## 🤖 クイズ生成の絶対ルール
-        1. **正解の重複禁止**: 全{num_questions}問において、正解となる単語はすべて異なるものにすること。
+        1. **正解の重複禁止**: すべての問題において、正解となる単語はすべて異なるものにすること。
         2. **問題文の重複禁止(重要)**: すべての問題文（question）は、言い回しや問う内容を変え、**1つとして同じ文章にしてはいけません**。
         3. **配置のランダム化**: 選択肢の正解位置はランダムにすること。
         4. **JSON配列で出力**: 指定された問題数を、1つのJSON配列（リスト）として出力すること。
-
-        【学習データ】
-        {data_content}
         """
 
         if difficulty == "初級":
-            prompt = base_instruction + f"""
-            初級レベルの三択問題を**{num_questions}問**生成してください。
+            return base_instruction + """
+            初級レベルの三択問題を、指定された問題数だけ生成してください。
             
             ### 出力例（このように異なる問題文を作成すること）:
             [
-              {{
+              {
                 "question": "CPUの役割として正しいものはどれか？",
                 "choices": ["演算処理", "記憶", "入力"],
                 "answer": "演算処理"
-              }},
-              {{
+              },
+              {
                 "question": "データを一時的に保存する装置は何か？",
                 "choices": ["HDD", "メモリ", "マウス"],
                 "answer": "メモリ"
-              }}
+              }
             ]
             
-            以下の形式のJSON配列のみを出力してください（Markdown記法は不要）：
+            この形式のJSON配列のみを出力してください（Markdown記法は不要）。
             """
         elif difficulty == "中級":
-            prompt = base_instruction + f"""
-            中級レベルの単語入力問題（記述式）を**{num_questions}問**生成してください。
+            return base_instruction + """
+            中級レベルの単語入力問題（記述式）を、指定された問題数だけ生成してください。
             答えは学習データに含まれる単語にしてください。
             
             ### 出力例（このように異なる問題文を作成すること）:
             [
-              {{
+              {
                 "question": "コンピュータの頭脳と呼ばれる装置は何か？",
                 "answer": "CPU"
-              }},
-              {{
+              },
+              {
                 "question": "Webサイトを閲覧するために使うソフトは？",
                 "answer": "ブラウザ"
-              }}
+              }
             ]
             
-            以下の形式のJSON配列のみを出力してください（Markdown記法は不要）：
+            この形式のJSON配列のみを出力してください（Markdown記法は不要）。
             """
+        raise ValueError(f"未対応の難易度です: {difficulty}")
 
-        # --- AI 実行 ---
+    def build_prompt(self, difficulty, data_content, num_questions, exclude_answers=None):
+        """
+        難易度と学習データからプロンプト（チャットのメッセージのリスト）を作成する
+        固定の指示を先頭のシステムメッセージに、毎回変わる学習データと問題数を後ろのユーザーメッセージに置く
+        exclude_answers を渡すと、それらを正解にしないよう指示する（不足分の追加生成用）
+        """
+        system = self.system_prompt(difficulty)
+        user = f"""
+        【学習データ】
+        {data_content}
+
+        上の学習データから、問題を**{num_questions}問**生成してください。
+        """
+        if exclude_answers:
+            user += f"""
+        次の語は既に出題済みなので、正解にしないこと: {"、".join(exclude_answers)}
+        """
+        return [
+            {"role": "system", "content": system},
+            {"role": "user", "content": user},
+        ]
+
+    def _shard_jobs(self, difficulty, source_rows, num_questions, shards=None):
+        """
+        抽出した行と問題数を、重ならない shards 個に分けたプロンプトのリストにする
+        （行の分け方は1行ずつ順番に配る）
+        """
+        shards = max(1, min(shards or self.num_shards, num_questions, len(source_rows) or 1))
+        jobs = []
+        for k in range(shards):
+            rows = source_rows[k::shards]
+            count = num_questions // shards + (1 if k < num_questions % shards else 0)
+            data_content = "".join(line for _, line in rows) or "データがありません。"
+            jobs.append(self.build_prompt(difficulty, data_content, count))
+        return jobs
+
+    def warm_up(self):
+        """
+        各AIサーバーにモデルを読み込ませておく（1問目の生成で読み込みを待たないように）
+        Ollama には空のプロンプトと keep_alive を送り、それ以外のサーバーには1トークンだけ生成させる
+        """
+        ok = True
+        for endpoint in self.endpoints.endpoints:
+            started = time.monotonic()
+            try:
+                response = self.http_client.post(
+                    f"{endpoint.ollama_url}/api/generate",
+                    json={"model": endpoint.model, "prompt": "", "keep_alive": KEEP_ALIVE},
+                )
+                if response.status_code == 404:
+                    endpoint.client.chat.completions.create(
+                        model=endpoint.model,
+                        messages=[{"role": "user", "content": "OK"}],
+                        max_tokens=1,
+                    )
+                else:
+                    response.raise_for_status()
+            except Exception as e:
+                print(f"モデルの準備に失敗しました（{endpoint.name}）: {e}")
+                ok = False
+                continue
+            print(f"モデルの準備ができました（{endpoint.name}, {time.monotonic() - started:.1f}秒）")
+        return ok
+
+    def _completion_options(self, endpoint, difficulty=None, pin_slot=True):
+        """
+        問い合わせに追加する設定
+        サーバーごとの追加の項目（extra_body）と、構造化出力が有効なら response_format
+        pin_slot=False なら難易度のスロットに固定しない（同じサーバーへの追加の依頼用）
+        """
+        options = {}
+        extra_body = None
+        if endpoint.extra_body is not None:
+            extra_body = dict(endpoint.extra_body)
+            if self.pin_slots and pin_slot and difficulty in SLOT_BY_DIFFICULTY:
+                extra_body["id_slot"] = SLOT_BY_DIFFICULTY[difficulty]
+        if extra_body:
+            options["extra_body"] = extra_body
+        if self.structured_output and difficulty is not None:
+            options["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "quiz_list", "schema": quiz_json_schema(difficulty)},
+            }
+        return options
+
+    def request_completion(self, prompt, difficulty=None, timeout=None):
+        """
+        AIに1回問い合わせ、(応答の本文, 応答したモデル名) を返す（timeout 秒を過ぎたら例外）
+        """
+        endpoint = self.endpoints.choose(difficulty)
+        options = self._completion_options(endpoint, difficulty)
+        if timeout is not None:
+            options["timeout"] = timeout
+        started = time.monotonic()
         try:
-            response = self.client.chat.completions.create(
-                model=MODEL_NAME,
-                messages=[{"role": "user", "content": prompt}],
+            response = endpoint.client.chat.completions.create(
+                model=endpoint.model,
+                messages=prompt,
                 temperature=0.8, # 多様性を出すために少し高め
+                **options,
             )
-            text = response.choices[0].message.content
+        except Exception as e:
+            self.endpoints.report_failure(endpoint, e)
+            raise
+        self.endpoints.report_success(endpoint)
+        text = response.choices[0].message.content or ""
+        self._record_usage(
+            endpoint, prompt, text, getattr(response, "usage", None), time.monotonic() - started
+        )
+        return text, endpoint.model
 
-            # --- JSON抽出 ---
-            match = re.search(r"\[\s*\{[\s\S]*\}\s*\]", text)
-            if not match:
-                match = re.search(r"\{[\s\S]*\}", text)
-                if not match: return None
-            
-            json_str = match.group()
-            raw_quiz_list = json.loads(json_str)
+    def _record_usage(self, endpoint, prompt, text, usage, seconds, questions=None):
+        """
+        使用トークン数（response.usage、なければ概算）と所要時間を記録する
+        questions を省略すると応答に含まれる問題の数を数える
+        """
+        if usage is not None and getattr(usage, "completion_tokens", None):
+            prompt_tokens, completion_tokens = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt_tokens = sum(estimate_tokens(m["content"]) for m in prompt)
+            completion_tokens = estimate_tokens(text)
+        if questions is None:
+            questions = len(IncrementalQuizParser().feed(text))
+        self.throughput.record(endpoint.key, prompt_tokens, completion_tokens, seconds, questions)
 
-            # --- Python側での重複排除（安全装置） ---
-            unique_quiz_list = []
-            seen_questions = set()
-            
-            for quiz in raw_quiz_list:
+    def plan_batch(self, num_questions, difficulty=None):
+        """
+        計測した生成速度で TARGET_READY_SECONDS 以内に揃う (問題数, 同時リクエスト数) を返す
+        遅い・混んでいるサーバーなら問題数を減らして、まず少しだけ早く作る
+        無効または未計測なら (num_questions, None)
+        """
+        if not self.adaptive_batch:
+            return num_questions, None
+        try:
+            stats = self.throughput.get(self.endpoints.choose(difficulty).key)
+        except RuntimeError:
+            stats = None
+        if stats is None:
+            return num_questions, None
+        # 1リクエストで目標時間内に出力できる問題数（多めに頼む分も考慮する）
+        per_request = int(
+            self.target_ready_seconds * stats["tokens_per_sec"]
+            / (stats["tokens_per_question"] * self.overgenerate_ratio)
+        )
+        per_request = max(1, min(num_questions, per_request))
+        shards = max(1, min(self.num_shards, math.ceil(num_questions / per_request)))
+        return min(num_questions, per_request * shards), shards
+
+    @staticmethod
+    def attach_model(quiz_list, model):
+        """問題を作ったモデル名を記録する（問題バンクとJSONLに保存する）"""
+        for quiz in quiz_list or []:
+            quiz["model"] = model
+        return quiz_list
+
+    @staticmethod
+    def parse_quiz_text(text, difficulty=None):
+        """
+        AIの応答から問題のオブジェクトを取り出してリストにする（1つもなければ None）
+        括弧と文字列を考慮して1回だけ走査するので、前後の説明文や壊れた問題があっても
+        読めた問題だけを返す。difficulty を渡すと形式の正しい問題だけに絞る
+        """
+        quiz_list = IncrementalQuizParser().feed(text or "")
+        if difficulty is not None:
+            quiz_list = [quiz for quiz in quiz_list if is_valid_quiz(difficulty, quiz)]
+        return quiz_list or None
+
+    @staticmethod
+    def bank_source(filename, sheet=0):
+        """問題バンクでの出題範囲の名前（ワークブックとシート、またはフォルダ）"""
+        path = os.path.abspath(filename)
+        return path if os.path.isdir(path) else f"{path}#{sheet}"
+
+    def _bank_valid_rows(self, filename, sheet=0):
+        """今のExcelにある行の内容ハッシュの集合（フォルダなら None = 確認しない）"""
+        if os.path.isdir(filename):
+            return None
+        with self._lock:
+            return self.workbook_cache.load(filename, sheet).rows_by_key().keys()
+
+    def serve_from_bank(self, difficulty, filename, num_questions=10, sheet=0):
+        """
+        問題バンクに十分な問題があれば、AIを使わずに num_questions 問を返す（なければ None）
+        """
+        if self.question_bank is None or self.sampling_mode not in BANK_SAMPLING_MODES:
+            return None
+        source = self.bank_source(filename, sheet)
+        try:
+            if self.question_bank.count(source, difficulty) < max(BANK_MIN_QUESTIONS, num_questions):
+                return None
+            return self.question_bank.serve(
+                source, difficulty, num_questions, self._bank_valid_rows(filename, sheet)
+            )
+        except Exception as e:
+            print(f"問題バンクから読み込めませんでした: {e}")
+            return None
+
+    def top_up_bank(self, difficulty, filename, num_questions=10, sheet=0):
+        """
+        まだ出題していない問題が少なければ、AIで生成してバンクに補充する（出題はしない）
+        """
+        if self.question_bank is None or self.sampling_mode not in BANK_SAMPLING_MODES:
+            return
+        source = self.bank_source(filename, sheet)
+        if self.question_bank.count(source, difficulty, unserved_only=True) >= num_questions:
+            return
+        key = (difficulty, source)
+        with self._prefetch_lock:
+            # 次の回の問題を作っている最中なら、同時に2つ目の生成は頼まない
+            if key in self._prefetching:
+                return
+            self._prefetching.add(key)
+        try:
+            self.generate_quiz_batch(difficulty, filename, num_questions, sheet, served=False)
+        finally:
+            with self._prefetch_lock:
+                self._prefetching.discard(key)
+                self._prefetch_lock.notify_all()
+
+    def _store_in_bank(self, difficulty, filename, sheet, quiz_list, served=True):
+        """生成した問題を問題バンクに保存する"""
+        if self.question_bank is None or not quiz_list:
+            return
+        try:
+            self.question_bank.add(self.bank_source(filename, sheet), difficulty, quiz_list, served=served)
+        except sqlite3.Error as e:
+            print(f"問題バンクに保存できませんでした: {e}")
+
+    @staticmethod
+    def source_signature(filename):
+        """Excelが変更されたかを判定するための状態（フォルダなら中の全ワークブック分）"""
+        if os.path.isdir(filename):
+            return tuple(
+                file_signature(os.path.join(filename, name))
+                for name in sorted(os.listdir(filename)) if CorpusCatalog.is_workbook(name)
+            )
+        return file_signature(filename)
+
+    def prefetch(self, difficulty, filename, num_questions=10, sheet=0):
+        """
+        次の回の問題をバックグラウンドで生成して貯めておく（既に prefetch_depth 回分あれば何もしない）
+        問題バンクには未出題として保存し、take_prefetched で取り出したときに出題済みにする
+        """
+        key = (difficulty, self.bank_source(filename, sheet))
+        with self._prefetch_lock:
+            if key in self._prefetching or len(self._prefetched.get(key, [])) >= self.prefetch_depth:
+                return
+            self._prefetching.add(key)
+
+        def worker():
+            try:
+                signature = self.source_signature(filename)
+                quiz_list = self.generate_quiz_batch(
+                    difficulty, filename, num_questions, sheet, served=False
+                )
+                if quiz_list:
+                    with self._prefetch_lock:
+                        self._prefetched.setdefault(key, []).append((signature, quiz_list))
+            except Exception as e:
+                print(f"Error generating quiz: {e}")
+            finally:
+                with self._prefetch_lock:
+                    self._prefetching.discard(key)
+                    self._prefetch_lock.notify_all()
+
+        threading.Thread(target=worker, daemon=True).start()
+
+    def wait_prefetch(self, difficulty, filename, sheet=0):
+        """この難易度・出題範囲の問題をバックグラウンドで生成中なら、終わるまで待つ"""
+        key = (difficulty, self.bank_source(filename, sheet))
+        with self._prefetch_lock:
+            self._prefetch_lock.wait_for(lambda: key not in self._prefetching)
+
+    def take_prefetched(self, difficulty, filename, sheet=0, served=True):
+        """
+        先に作っておいた問題を1回分取り出す（なければ None）
+        作った後でExcelが変更されていたら、その問題は捨てる
+        served=False なら問題バンクでは未出題のままにする（受け渡しファイルに移すとき）
+        """
+        key = (difficulty, self.bank_source(filename, sheet))
+        signature = self.source_signature(filename)
+        with self._prefetch_lock:
+            batches = self._prefetched.get(key, [])
+            quiz_list = None
+            while batches and quiz_list is None:
+                batch_signature, batch = batches.pop(0)
+                if batch_signature == signature:
+                    quiz_list = batch
+        if quiz_list is not None and served:
+            self._mark_served(difficulty, key[1], quiz_list)
+        return quiz_list
+
+    def _mark_served(self, difficulty, source, quiz_list):
+        """先に作っておいた問題を、実際に出題するときに問題バンクで出題済みにする"""
+        if self.question_bank is None:
+            return
+        try:
+            self.question_bank.mark_served(source, difficulty, quiz_list)
+        except sqlite3.Error as e:
+            print(f"問題バンクに保存できませんでした: {e}")
+
+    def _read_handoff(self):
+        try:
+            with open(self.handoff_file, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return []
+
+    def _write_handoff(self, entries):
+        try:
+            os.makedirs(os.path.dirname(self.handoff_file), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.handoff_file), prefix=".handoff-")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp, self.handoff_file)
+        except OSError as e:
+            print(f"次の回の問題を保存できませんでした: {e}")
+
+    def save_handoff(self, difficulty, filename, sheet=0, num_questions=10):
+        """
+        次の回の問題を用意して受け渡しファイルに保存する（運動中など、アプリを閉じている間に使う）
+        先に作っておいた問題があればそれを（生成中なら終わるのを待って）、なければ新しく生成する
+        問題バンクには未出題として保存し、take_handoff で取り出したときに出題済みにする
+        """
+        signature = self.source_signature(filename)
+        self.wait_prefetch(difficulty, filename, sheet)
+        quiz_list = self.take_prefetched(difficulty, filename, sheet, served=False)
+        if not quiz_list:
+            quiz_list = self.generate_quiz_batch(difficulty, filename, num_questions, sheet, served=False)
+        if not quiz_list:
+            return
+        source = self.bank_source(filename, sheet)
+        entries = [
+            e for e in self._read_handoff()
+            if (e.get("difficulty"), e.get("source")) != (difficulty, source)
+        ]
+        entries.append({
+            "difficulty": difficulty,
+            "source": source,
+            "signature": signature,
+            "quiz_list": quiz_list,
+        })
+        self._write_handoff(entries)
+
+    def take_handoff(self, difficulty, filename, sheet=0):
+        """
+        受け渡しファイルから、この難易度・出題範囲の問題を取り出す（なければ None）
+        保存した後でExcelが変更されていたら捨てる
+        """
+        entries = self._read_handoff()
+        if not entries:
+            return None
+        source = self.bank_source(filename, sheet)
+        # JSONに保存するとタプルはリストになるので、同じ形にして比べる
+        signature = json.loads(json.dumps(self.source_signature(filename)))
+        quiz_list = None
+        rest = []
+        for entry in entries:
+            if (entry.get("difficulty"), entry.get("source")) != (difficulty, source):
+                rest.append(entry)
+            elif entry.get("signature") == signature:
+                quiz_list = entry.get("quiz_list")
+        if len(rest) != len(entries):
+            self._write_handoff(rest)
+        if quiz_list:
+            self._mark_served(difficulty, source, quiz_list)
+        return quiz_list or None
+
+    def is_new_question(self, quiz, pending=None):
+        """
+        過去に作った問題（と pending に集めた今回の問題）の言い換えでなければ True
+        pending（dict）を渡すと、新しい問題の指紋を問題文をキーにして入れておく。
+        この時点では登録しない（出題・保存が決まってから remember_questions で登録する）
+        """
+        if self.fingerprints is None:
+            return True
+        fingerprint = self.fingerprints.fingerprint(quiz["question"], quiz["answer"])
+        if self.fingerprints.is_duplicate(fingerprint, (pending or {}).values()):
+            return False
+        if pending is not None:
+            pending[quiz["question"]] = fingerprint
+        return True
+
+    def remember_questions(self, quiz_list, pending):
+        """出題・保存した問題の指紋を登録する（ファイルへの保存は save_fingerprints）"""
+        if self.fingerprints is None:
+            return
+        self.fingerprints.add(pending[q["question"]] for q in quiz_list if q["question"] in pending)
+
+    def save_fingerprints(self):
+        if self.fingerprints is not None:
+            self.fingerprints.save()
+
+    def _requested_count(self, num_questions):
+        """多めに頼む問題数"""
+        return max(num_questions, math.ceil(num_questions * self.overgenerate_ratio))
+
+    def _top_up_prompt(self, difficulty, source_rows, missing, quiz_list):
+        """足りない missing 問だけを、既にある正解を除いて頼むプロンプト"""
+        data_content = "".join(line for _, line in source_rows) or "データがありません。"
+        answers = [str(quiz.get("answer", "")) for quiz in quiz_list]
+        return self.build_prompt(difficulty, data_content, missing, exclude_answers=answers)
+
+    def _top_up_time_left(self, started, rounds, cancel_event=None):
+        """不足分をもう一度頼めるなら残り時間（秒）、頼めなければ None"""
+        if rounds >= MAX_TOP_UP_ROUNDS:
+            return None
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        remaining = self.top_up_budget - (time.monotonic() - started)
+        return remaining if remaining > 0 else None
+
+    def generate_quiz_batch(self, difficulty, filename, num_questions=10, sheet=0, keywords=None,
+                            cancel_event=None, shards=None, served=True):
+        """
+        指定されたExcelファイルの内容に基づいて、指定数分の問題を【一括生成】する
+        keywords を指定すると、キーワードに一致する行だけを出題範囲にする
+        cancel_event（threading.Event）がセットされたら結果を捨てて None を返す
+        shards（省略時は self.num_shards）が2以上なら、行と問題数を分けて同時に問い合わせる
+        生成した問題は問題バンクにも保存する（served=False なら未出題として）
+        形式の崩れた問題だけを捨て、足りない分は時間の上限まで追加で頼む
+        """
+        started = time.monotonic()
+        try:
+            _, source_rows = self._load_batch_rows(
+                filename, num_questions, sheet, keywords, difficulty
+            )
+            prompts = self._shard_jobs(
+                difficulty, source_rows, self._requested_count(num_questions), shards
+            )
+        except Exception as e:
+            print(e)
+            return None
+
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+
+        # --- AI 実行 ---
+        def run(prompt, timeout=None):
+            try:
+                if self.hedge_requests:
+                    return list(self._hedged_quizzes(difficulty, prompt, cancel_event, timeout)) or None
+                text, model = self.request_completion(prompt, difficulty, timeout)
+                return self.attach_model(self.parse_quiz_text(text, difficulty), model)
+            except Exception as e:
+                print(f"Error generating quiz: {e}")
+                return None
+
+        if len(prompts) == 1:
+            results = [run(prompts[0])]
+        else:
+            # 分割したリクエストを同時に送る（待ち時間はおよそ分割数分の1になる）
+            with ThreadPoolExecutor(max_workers=len(prompts)) as pool:
+                results = list(pool.map(run, prompts))
+
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+
+        # --- Python側での重複排除（安全装置） ---
+        unique_quiz_list = []
+        seen_questions = set()
+        fingerprints = {}  # 問題文 -> 指紋（返す・保存すると決まってから登録する）
+
+        def collect(raw_quiz_list, skip_answers=()):
+            for quiz in raw_quiz_list or []:
                 q_text = quiz.get("question", "")
-                # 問題文が既に存在する場合はスキップ
-                if q_text not in seen_questions:
+                # 問題文が既に存在する場合（追加分は正解が既にある場合も）、
+                # 過去の問題の言い換えの場合はスキップ（足りなくなった分は追加で頼む）
+                if q_text in seen_questions or quiz.get("answer") in skip_answers:
+                    continue
+                seen_questions.add(q_text)
+                if self.is_new_question(quiz, fingerprints):
                     unique_quiz_list.append(quiz)
-                    seen_questions.add(q_text)
 
-            return unique_quiz_list
-            
-        except Exception as e:
-            print(f"Error generating quiz: {e}")
+        for raw_quiz_list in results:
+            collect(raw_quiz_list)
+
+        # 足りなければ、読めた問題は残して不足分だけを頼む（全部失敗した場合も同じ）
+        rounds = 0
+        while len(unique_quiz_list) < num_questions:
+            time_left = self._top_up_time_left(started, rounds, cancel_event)
+            if time_left is None:
+                break
+            rounds += 1
+            missing = num_questions - len(unique_quiz_list)
+            print(f"問題が{missing}問足りないため、追加で生成します")
+            prompt = self._top_up_prompt(difficulty, source_rows, missing, unique_quiz_list)
+            collect(run(prompt, time_left), {quiz.get("answer") for quiz in unique_quiz_list})
+
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        if not unique_quiz_list:
             return None
 
+        # 間違えたときに苦手度を上げる行を記録しておく
+        self.attach_source_rows(unique_quiz_list, source_rows)
+        # 多めに頼んで余った問題は、未出題としてバンクに残す
+        extra_quiz_list = unique_quiz_list[num_questions:]
+        unique_quiz_list = unique_quiz_list[:num_questions]
+        # キーワードで絞った問題は出題範囲が違うのでバンクには入れない
+        if keywords:
+            extra_quiz_list = []
+        else:
+            self._store_in_bank(difficulty, filename, sheet, unique_quiz_list, served)
+            self._store_in_bank(difficulty, filename, sheet, extra_quiz_list, served=False)
+        self.remember_questions(unique_quiz_list + extra_quiz_list, fingerprints)
+        self.save_fingerprints()
+        return unique_quiz_list
+
+    def _stream_quizzes(self, difficulty, prompt, cancel_event=None, timeout=None,
+                        endpoint=None, pin_slot=True, streams=None):
+        """
+        1回のストリーミング問い合わせから、完成した問題を順に yield する
+        endpoint を省略すると、難易度に合うサーバーを選ぶ
+        streams（リスト）を渡すと開いたストリームを追加するので、別のスレッドから close() できる
+        """
+        parser = IncrementalQuizParser()
+        endpoint = endpoint or self.endpoints.choose(difficulty)
+        options = self._completion_options(endpoint, difficulty, pin_slot)
+        if timeout is not None:
+            options["timeout"] = timeout
+        started = time.monotonic()
+        try:
+            stream = endpoint.client.chat.completions.create(
+                model=endpoint.model,
+                messages=prompt,
+                temperature=0.8, # 多様性を出すために少し高め
+                stream=True,
+                stream_options={"include_usage": True},  # 最後のチャンクで使用トークン数を受け取る
+                **options,
+            )
+        except Exception as e:
+            self.endpoints.report_failure(endpoint, e)
+            raise
+        self.endpoints.report_success(endpoint)
+        if streams is not None:
+            streams.append(stream)
+        text, usage, parsed = [], None, 0
+        try:
+            if cancel_event is not None and cancel_event.is_set():
+                return  # 開いている間に中止された
+            for chunk in stream:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                usage = getattr(chunk, "usage", None) or usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content or ""
+                text.append(delta)
+                for quiz in parser.feed(delta):
+                    parsed += 1
+                    # 形式が崩れた問題はスキップ
+                    if is_valid_quiz(difficulty, quiz):
+                        quiz["model"] = endpoint.model
+                        yield quiz
+            # 最後まで受け取れた場合だけ速度を記録する
+            self._record_usage(
+                endpoint, prompt, "".join(text), usage, time.monotonic() - started, parsed
+            )
+        finally:
+            stream.close()
+
+    def hedge_deadline(self, difficulty):
+        """追加の依頼を送るまでの秒数（最近の1問目までの時間の HEDGE_PERCENTILE 分位点）"""
+        if HEDGE_DEADLINE_SECONDS is not None:
+            return HEDGE_DEADLINE_SECONDS
+        with self._hedge_lock:
+            latencies = sorted(self._latencies.get(difficulty, ()))
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DEADLINE
+        return latencies[min(len(latencies) - 1, int(len(latencies) * HEDGE_PERCENTILE))]
+
+    def hedge_report(self):
+        """追加の依頼を送った割合と、どちらが先に結果を返したかの集計"""
+        with self._hedge_lock:
+            report = dict(self.hedge_stats)
+        requests = report["requests"] or 1
+        hedged = report["hedged"] or 1
+        report["hedge_rate"] = report["hedged"] / requests
+        report["hedge_win_rate"] = report["hedge_wins"] / hedged
+        return report
+
+    def _hedged_quizzes(self, difficulty, prompt, cancel_event=None, timeout=None):
+        """
+        AIに問い合わせ、hedge_deadline を過ぎても1問目が届かなければ、同じ依頼を別のサーバー
+        （HEDGE_SAME_ENDPOINT なら同じサーバーの別スロット）にも送る。
+        先に正しい問題を1問届けた側を採用してその問題を順に yield し、もう一方は中止する
+        """
+        primary = self.endpoints.choose(difficulty)
+        deadline = self.hedge_deadline(difficulty)
+        results = queue.Queue()
+        # 依頼ごとの (中止フラグ, 開いたストリーム)。負けた側を勝った側から閉じるため
+        attempts = {}
+
+        def attempt(endpoint, is_hedge):
+            cancel, streams = attempts[is_hedge] = (threading.Event(), [])
+
+            def work():
+                try:
+                    for quiz in self._stream_quizzes(
+                        difficulty, prompt, cancel, timeout, endpoint,
+                        pin_slot=not is_hedge, streams=streams,
+                    ):
+                        results.put((is_hedge, quiz))
+                except Exception as e:
+                    if not cancel.is_set():
+                        print(f"Error generating quiz: {e}")
+                finally:
+                    results.put((is_hedge, None))  # この依頼の終わり
+
+            threading.Thread(target=work, daemon=True).start()
+
+        def stop(is_hedge):
+            # 次のチャンクを待たずに、ストリームを閉じて止める
+            cancel, streams = attempts[is_hedge]
+            cancel.set()
+            for stream in list(streams):
+                try:
+                    stream.close()
+                except Exception:
+                    pass
+
+        with self._hedge_lock:
+            self.hedge_stats["requests"] += 1
+        # 1問目までの時間は追加の依頼からではなく、最初の依頼を送った時点から測る
+        started = time.monotonic()
+        attempt(primary, False)
+        running, hedged, winner = 1, False, None
+        try:
+            while running or (winner is None and not hedged):
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                wait = HEDGE_POLL_SECONDS
+                if winner is None and not hedged:
+                    wait = min(wait, max(0.0, deadline - (time.monotonic() - started)))
+                try:
+                    is_hedge, quiz = results.get(timeout=wait)
+                except queue.Empty:
+                    if winner is not None or hedged or time.monotonic() - started < deadline:
+                        continue
+                    # 期限を過ぎた。別のサーバーがあればそちらへ、なければ設定により同じサーバーへ送る
+                    hedged = True
+                    try:
+                        backup = self.endpoints.choose(difficulty, exclude=(primary,))
+                    except RuntimeError:
+                        backup = primary if HEDGE_SAME_ENDPOINT else None
+                    if backup is not None:
+                        print(f"1問目が{deadline:.1f}秒を過ぎても届かないため、{backup.name} にも同じ依頼を送ります")
+                        with self._hedge_lock:
+                            self.hedge_stats["hedged"] += 1
+                        attempt(backup, True)
+                        running += 1
+                    continue
+                if quiz is None:
+                    running -= 1
+                    if is_hedge == winner:
+                        break  # 採用した側が最後まで届いた
+                    if winner is None and not hedged:
+                        deadline = 0.0  # 最初の依頼が失敗したら、期限を待たずに送る
+                    continue
+                if winner is None:
+                    winner = is_hedge
+                    for other in attempts:
+                        if other != winner:
+                            stop(other)
+                    with self._hedge_lock:
+                        self.hedge_stats["hedge_wins" if is_hedge else "primary_wins"] += 1
+                        self._latencies.setdefault(difficulty, deque(maxlen=100)).append(
+                            time.monotonic() - started
+                        )
+                if is_hedge == winner:
+                    yield quiz
+        finally:
+            # 中止されたり途中で打ち切られたりしても、残っている依頼を止める
+            for is_hedge in list(attempts):
+                stop(is_hedge)
+        if winner is None:
+            with self._hedge_lock:
+                self.hedge_stats["failed"] += 1
+
+    def generate_quiz_stream(self, difficulty, filename, num_questions=10, sheet=0, keywords=None,
+                             cancel_event=None, shards=None):
+        """
+        generate_quiz_batch のストリーミング版。
+        AIの出力を少しずつ受け取り、問題が1つ完成するたびにその問題を yield する。
+        1問目は全問の生成を待たずに出題できる。分割した場合は届いた順に混ぜて返す。
+        多めに頼んだ分は yield せずに問題バンクへ残し、足りなければ不足分だけを追加で頼む。
+        """
+        started = time.monotonic()
+        try:
+            _, source_rows = self._load_batch_rows(
+                filename, num_questions, sheet, keywords, difficulty
+            )
+            prompts = self._shard_jobs(
+                difficulty, source_rows, self._requested_count(num_questions), shards
+            )
+        except Exception as e:
+            print(e)
+            return
+
+        results = queue.Queue()
+
+        def worker(prompt, timeout=None):
+            try:
+                if self.hedge_requests:
+                    quizzes = self._hedged_quizzes(difficulty, prompt, cancel_event, timeout)
+                else:
+                    quizzes = self._stream_quizzes(difficulty, prompt, cancel_event, timeout)
+                for quiz in quizzes:
+                    results.put(quiz)
+            except Exception as e:
+                print(f"Error generating quiz: {e}")
+            finally:
+                results.put(None)  # このリクエストの終わり
+
+        for prompt in prompts:
+            threading.Thread(target=worker, args=(prompt,), daemon=True).start()
+
+        yielded = []
+        seen_questions = set()
+        fingerprints = {}  # 問題文 -> 指紋（出題・保存した問題だけ登録する）
+        remaining = len(prompts)
+        rounds = 0
+        while True:
+            if not remaining:
+                # 足りなければ、出した問題の正解を除いて不足分だけを追加で頼む
+                if len(yielded) >= num_questions:
+                    break
+                time_left = self._top_up_time_left(started, rounds, cancel_event)
+                if time_left is None:
+                    break
+                rounds += 1
+                missing = num_questions - len(yielded)
+                print(f"問題が{missing}問足りないため、追加で生成します")
+                prompt = self._top_up_prompt(difficulty, source_rows, missing, yielded)
+                threading.Thread(target=worker, args=(prompt, time_left), daemon=True).start()
+                remaining = 1
+            quiz = results.get()
+            if quiz is None:
+                remaining -= 1
+                continue
+            if cancel_event is not None and cancel_event.is_set():
+                continue  # 残りのスレッドの終了を待つだけ
+            # 問題文の重複（追加分は正解の重複も）はスキップ
+            if quiz["question"] in seen_questions:
+                continue
+            if rounds and any(quiz.get("answer") == q.get("answer") for q in yielded):
+                continue
+            seen_questions.add(quiz["question"])
+            # 過去の問題の言い換えはスキップ（足りなくなった分は追加で頼む）
+            if not self.is_new_question(quiz, fingerprints):
+                continue
+            self.attach_source_rows([quiz], source_rows)
+            if len(yielded) >= num_questions:
+                # 多めに頼んだ分は出題せず、未出題としてバンクに残す
+                if not keywords:
+                    self._store_in_bank(difficulty, filename, sheet, [quiz], served=False)
+                    self.remember_questions([quiz], fingerprints)
+                continue
+            if not keywords:
+                self._store_in_bank(difficulty, filename, sheet, [quiz])
+            self.remember_questions([quiz], fingerprints)
+            yielded.append(quiz)
+            yield quiz
+        self.save_fingerprints()
+
     def check_answer(self, difficulty, quiz, user_answer):
         """ユーザーの回答を判定する"""
         if difficulty == "初級":
             return user_answer == quiz["answer"]
 
         elif difficulty == "中級":
-            def normalize(t):
-                # 全角・半角や大文字・小文字を統一して比較
-                t = unicodedata.normalize("NFKC", t.lower())
-                return "".join(
-                    c for c in t if c.isalnum() or "\u3040" <= c <= "\u9faf"
-                )
-            return normalize(user_answer) in normalize(quiz["answer"])
+            return normalize_answer(user_answer) in normalize_answer(quiz["answer"])
 
         return False
 
@@ -229,6 +3233,15 @@ class QuizApp:
         # 状態管理変数
         self.difficulty_var = tk.StringVar(value="初級")
         self.file_var = tk.StringVar(value="data.xlsx") 
+        self.sheet = 0
+
+        # 科目カタログ（フォルダ内のワークブック・シート一覧）
+        # 起動を待たせないよう、まず保存してある目録を使い、走査は別スレッドで行う
+        self.catalog = self.logic.catalog(scan=False)
+        self.initial_subject = self.default_subject()
+        self.subject_var = tk.StringVar(value=self.initial_subject)
+        self.subject_frame = None
+        self.keyword_var = tk.StringVar(value="")
         
         # クイズデータ管理用
         self.quiz_list = []      # 生成された全問題リスト
@@ -238,10 +3251,79 @@ class QuizApp:
         self.correct_count = 0
         self.wrong_count = 0
         self.quiz_frame = None
+        self.loading_frame = None
         self.loading_label = None
+        self.keywords = None
+        self.generation_cancel = threading.Event()
+        self.generating = False          # 生成スレッドが動いているか
+        self.quiz_started = False        # 1問目を出題したか
+        self.waiting_for_question = False
+        self.progress_label = None
+
+        # ユーザーが開始を押すまでに、AIサーバーにモデルを読み込ませておく
+        if WARM_UP:
+            threading.Thread(target=self.logic.warm_up, daemon=True).start()
+        # AIサーバーの応答確認をバックグラウンドで続ける（振り分けに使う）
+        self.logic.endpoints.start()
 
         # スタート画面の描画
         self.setup_start_screen()
+        self.start_catalog_scan()
+
+    def default_subject(self):
+        """file_var のワークブックの最初のシート（目録になければ全科目）"""
+        for entry in self.catalog.entries:
+            if os.path.basename(entry["path"]) == self.file_var.get() and entry["sheet"] == 0:
+                return entry["subject"]
+        return ALL_SUBJECTS
+
+    def start_catalog_scan(self):
+        """フォルダの走査を別スレッドで行い、終わったら科目の選択肢を更新する"""
+        results = queue.Queue()
+
+        def worker():
+            # Tkには触らず、結果をキューに入れるだけ
+            # 解析済みExcelのキャッシュは生成スレッドと共有なので、行の抽出と同じロックで守る
+            try:
+                with self.logic._lock:
+                    catalog = self.logic.catalog()
+                results.put(catalog)
+            except Exception as e:
+                print(f"目録を更新できませんでした: {e}")
+                results.put(None)
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(GENERATION_POLL_MS, self.poll_catalog, results)
+
+    def poll_catalog(self, results):
+        try:
+            catalog = results.get_nowait()
+        except queue.Empty:
+            self.root.after(GENERATION_POLL_MS, self.poll_catalog, results)
+            return
+        if catalog is None:
+            return
+        self.catalog = catalog
+        # まだ選び直していないか、選んでいた科目がなくなっていれば既定の科目にする
+        subject = self.subject_var.get()
+        if subject == self.initial_subject or subject != ALL_SUBJECTS and catalog.find(subject) is None:
+            self.subject_var.set(self.default_subject())
+        # スタート画面を表示中なら、科目の選択肢を作り直す
+        if self.subject_frame is not None and self.subject_frame.winfo_exists():
+            self.fill_subject_menu()
+
+    def fill_subject_menu(self):
+        """科目選択（カタログにワークブックがある場合のみ）"""
+        for widget in self.subject_frame.winfo_children():
+            widget.destroy()
+        if not self.catalog.entries:
+            return
+        tk.Label(self.subject_frame, text="科目を選択してください", bg=COLOR_BG, font=("Yu Gothic", 12)).pack(pady=(20, 5))
+        subject_menu = tk.OptionMenu(
+            self.subject_frame, self.subject_var, ALL_SUBJECTS, *self.catalog.subjects()
+        )
+        subject_menu.config(font=("Yu Gothic", 11), bg="white", width=20)
+        subject_menu.pack(pady=5)
 
     def setup_start_screen(self):
         """スタート画面（設定画面）の構築"""
@@ -271,6 +3353,17 @@ class QuizApp:
             bg=COLOR_BG, activebackground=COLOR_BG, font=("Yu Gothic", 11)
         ).pack(side=tk.LEFT, padx=10)
 
+        # 科目選択（目録の走査が終わったら作り直す）
+        self.subject_frame = tk.Frame(self.root, bg=COLOR_BG)
+        self.subject_frame.pack()
+        self.fill_subject_menu()
+
+        # キーワード指定（空欄なら全体からランダム）
+        tk.Label(
+            self.root, text="キーワード（任意・スペース区切り）", bg=COLOR_BG, font=("Yu Gothic", 12)
+        ).pack(pady=(20, 5))
+        tk.Entry(self.root, textvariable=self.keyword_var, font=("Yu Gothic", 12), width=30).pack(pady=5)
+
         # スタートボタン
         tk.Button(
             self.root, text="問題を生成して開始",
@@ -284,35 +3377,179 @@ class QuizApp:
         """クイズ開始前の準備（ロード画面表示とデータ生成）"""
         self.difficulty = self.difficulty_var.get()
         self.filename = self.file_var.get()
+        self.sheet = 0
+
+        # 科目が選ばれていれば、そのワークブック・シート（全科目ならフォルダ）を使う
+        if self.catalog.entries:
+            subject = self.subject_var.get()
+            entry = self.catalog.find(subject)
+            if entry is not None:
+                self.filename, self.sheet = entry["path"], entry["sheet"]
+            elif subject == ALL_SUBJECTS:
+                self.filename = self.catalog.directory
         
         if not os.path.exists(self.filename):
             messagebox.showerror("エラー", f"ファイル '{self.filename}' が見つかりません。\n実行フォルダに配置してください。")
             return
 
+        # Tkの変数は生成スレッドから読まないよう、ここで取り出しておく
+        self.keywords = self.keyword_var.get().strip() or None
+
         # 画面を一度クリア
         for widget in self.root.winfo_children():
             widget.destroy()
             
-        # ロード画面のラベルを保持
+        # ロード画面（メッセージ・経過時間・キャンセルボタン）
+        self.loading_frame = tk.Frame(self.root, bg=COLOR_BG)
+        self.loading_frame.pack(expand=True)
+
         self.loading_label = tk.Label(
-            self.root, text="AIが問題を生成しています...\n(10問作成中)", 
+            self.loading_frame, text="AIが問題を生成しています...\n(10問作成中)", 
             font=("Yu Gothic", 16), bg=COLOR_BG, fg=COLOR_TEXT_MAIN
         )
-        self.loading_label.pack(expand=True)
-        
-        self.root.update() # 画面描画を更新
+        self.loading_label.pack(pady=10)
+
+        self.elapsed_label = tk.Label(
+            self.loading_frame, text="経過時間: 0秒",
+            font=("Yu Gothic", 12), bg=COLOR_BG, fg=COLOR_TEXT_MAIN
+        )
+        self.elapsed_label.pack(pady=5)
+
+        tk.Button(
+            self.loading_frame, text="キャンセル",
+            bg="#ef5350", fg="white",
+            font=("Yu Gothic", 12),
+            width=15,
+            command=self.cancel_generation
+        ).pack(pady=20)
 
-        # 処理ブロック防止のため、少し待ってからデータ生成へ
-        self.root.after(100, self.generate_and_start)
+        self.generate_and_start()
 
     def generate_and_start(self):
-        """AIを使って一括生成し、完了したらクイズ画面へ"""
-        # AI処理（時間がかかる）
-        quiz_data = self.logic.generate_quiz_batch(self.difficulty, self.filename, num_questions=10)
-        
+        """
+        AIによる生成を別スレッドで開始し、結果はキューで受け取る
+        キューには ("quiz", 1問) が届くたびに入り、最後に ("done", 問題リスト or None) が入る
+        """
+        results = queue.Queue()
+        cancel = threading.Event()
+        self.generation_cancel = cancel
+        self.generation_started = time.monotonic()
+        self.generating = True
+        self.quiz_started = False
+        self.quiz_list = []
+        difficulty, filename, sheet, keywords = self.difficulty, self.filename, self.sheet, self.keywords
+        # 計測した生成速度から、最初に作る問題数を決める（ストリーミングでは1問目がすぐ届くので使わない）
+        first_count, first_shards = 10, None
+        if not self.logic.stream_responses:
+            first_count, first_shards = self.logic.plan_batch(10, difficulty)
+            if self.loading_label is not None and first_count < 10:
+                self.loading_label.config(text=f"AIが問題を生成しています...\n(まず{first_count}問作成中)")
+
+        def worker():
+            # AI処理（時間がかかる）。Tkには触らず、結果をキューに入れるだけ
+            quiz_data = None
+            try:
+                # 前の回の出題中（または運動中）に作っておいた問題か、
+                # 問題バンクに十分貯まっていれば、AIを待たずにすぐ出題する
+                if not keywords:
+                    quiz_data = (
+                        self.logic.take_prefetched(difficulty, filename, sheet)
+                        or self.logic.take_handoff(difficulty, filename, sheet)
+                        or self.logic.serve_from_bank(difficulty, filename, 10, sheet)
+                    )
+                if quiz_data:
+                    results.put(("done", quiz_data))
+                    # 出題中に、減った分をバックグラウンドで補充しておく
+                    self.logic.top_up_bank(difficulty, filename, 10, sheet)
+                    return
+                if self.logic.stream_responses:
+                    # 1問できるたびに渡し、最後は ("done", None) で終わりを知らせる
+                    for quiz in self.logic.generate_quiz_stream(
+                        difficulty, filename, num_questions=10, sheet=sheet,
+                        keywords=keywords, cancel_event=cancel,
+                    ):
+                        results.put(("quiz", quiz))
+                elif first_count < 10:
+                    # サーバーが遅いときは、目標時間で作れる分だけ先に作って出題を始め、
+                    # 残りは解いている間に作って追加する
+                    remaining, count, shards = 10, first_count, first_shards
+                    while remaining > 0 and not cancel.is_set():
+                        batch = self.logic.generate_quiz_batch(
+                            difficulty, filename, num_questions=count, sheet=sheet,
+                            keywords=keywords, cancel_event=cancel, shards=shards,
+                        )
+                        for quiz in batch or []:
+                            results.put(("quiz", quiz))
+                        if not batch or len(batch) < count:
+                            break  # 足りない分の追加生成も諦めた
+                        remaining -= len(batch)
+                        count, shards = self.logic.plan_batch(remaining, difficulty)
+                else:
+                    quiz_data = self.logic.generate_quiz_batch(
+                        difficulty, filename, num_questions=10, sheet=sheet,
+                        keywords=keywords, cancel_event=cancel, shards=first_shards,
+                    )
+            except Exception as e:
+                print(f"Error generating quiz: {e}")
+            results.put(("done", quiz_data))
+
+        threading.Thread(target=worker, daemon=True).start()
+        self.root.after(GENERATION_POLL_MS, self.poll_generation, results, cancel)
+
+    def poll_generation(self, results, cancel):
+        """生成スレッドからの結果を受け取り、まだ続くなら経過時間を更新して待つ"""
+        if cancel.is_set():
+            return  # キャンセル済み（遅れて届いた結果は捨てる）
+
+        while True:
+            try:
+                kind, payload = results.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "quiz":
+                self.receive_question(payload)
+            else:
+                self.finish_generation(payload)
+                return
+
+        if not self.quiz_started:
+            elapsed = int(time.monotonic() - self.generation_started)
+            self.elapsed_label.config(text=f"経過時間: {elapsed}秒")
+        self.root.after(GENERATION_POLL_MS, self.poll_generation, results, cancel)
+
+    def receive_question(self, quiz):
+        """ストリーミングで届いた1問を追加する（1問目ならクイズを開始する）"""
+        if not self.quiz_started:
+            self.start_quiz([quiz])
+            return
+        self.quiz_list.append(quiz)
+        self.update_progress_label()
+        if self.waiting_for_question:
+            self.show_next_question()
+
+    def finish_generation(self, quiz_data):
+        """生成が終わったときの処理"""
+        self.generating = False
+        if not self.quiz_started:
+            # 一括生成の結果（ストリーミングで1問も届かなかった場合は None）
+            self.start_quiz(quiz_data)
+            return
+        self.update_progress_label()
+        if self.waiting_for_question:
+            self.show_next_question()
+
+    def cancel_generation(self):
+        """生成を中止してスタート画面に戻る"""
+        self.generation_cancel.set()
+        self.loading_label = None
+        self.setup_start_screen()
+
+    def start_quiz(self, quiz_data):
+        """生成された問題を確認し、クイズ画面へ"""
         # ロード画面を確実に削除
-        if hasattr(self, 'loading_label') and self.loading_label:
-            self.loading_label.destroy()
+        if self.loading_frame:
+            self.loading_frame.destroy()
+            self.loading_frame = None
             self.loading_label = None
 
         if not quiz_data or not isinstance(quiz_data, list):
@@ -327,6 +3564,7 @@ class QuizApp:
 
         # 変数リセット
         self.quiz_list = quiz_data
+        self.quiz_started = True
         self.question_index = 0
         self.correct_count = 0
         self.wrong_count = 0
@@ -339,11 +3577,21 @@ class QuizApp:
         if self.quiz_frame:
             self.quiz_frame.destroy()
 
+        self.waiting_for_question = False
+
         # 全問終了チェック
         if self.question_index >= len(self.quiz_list):
+            if self.generating:
+                # 次の問題がまだ生成中なら、届くまで待つ
+                self.show_waiting_screen()
+                return
             self.show_final_result()
             return
 
+        # 今回の生成が終わっていれば、回答している間に次の回の問題を作っておく
+        if not self.generating and not self.keywords:
+            self.logic.prefetch(self.difficulty, self.filename, 10, self.sheet)
+
         # 現在の問題を取得
         self.current_quiz = self.quiz_list[self.question_index]
 
@@ -351,11 +3599,13 @@ class QuizApp:
         self.quiz_frame = tk.Frame(self.root, bg=COLOR_BG)
         self.quiz_frame.pack(pady=20, fill="both", expand=True)
 
-        # 問題番号
-        tk.Label(
-            self.quiz_frame, text=f"第 {self.question_index + 1} 問 / 全{len(self.quiz_list)}問",
+        # 問題番号（生成中は問題数が増えていくので、後から更新できるよう保持）
+        self.progress_label = tk.Label(
+            self.quiz_frame, text="",
             bg=COLOR_BG, fg=COLOR_TEXT_MAIN, font=("Yu Gothic", 16, "bold")
-        ).pack(pady=5)
+        )
+        self.progress_label.pack(pady=5)
+        self.update_progress_label()
 
         # 問題文
         tk.Label(
@@ -370,6 +3620,25 @@ class QuizApp:
         else:
             self.create_input_field()
 
+    def update_progress_label(self):
+        """問題番号の表示を更新する"""
+        if not self.progress_label or not self.progress_label.winfo_exists():
+            return
+        text = f"第 {self.question_index + 1} 問 / 全{len(self.quiz_list)}問"
+        if self.generating:
+            text += "（生成中）"
+        self.progress_label.config(text=text)
+
+    def show_waiting_screen(self):
+        """次の問題が届くのを待つ画面"""
+        self.waiting_for_question = True
+        self.quiz_frame = tk.Frame(self.root, bg=COLOR_BG)
+        self.quiz_frame.pack(pady=20, fill="both", expand=True)
+        tk.Label(
+            self.quiz_frame, text="次の問題を生成しています...",
+            font=("Yu Gothic", 16), bg=COLOR_BG, fg=COLOR_TEXT_MAIN
+        ).pack(expand=True)
+
     def create_choice_buttons(self, quiz):
         """初級用：三択ボタンの生成"""
         choices = quiz["choices"]
@@ -409,6 +3678,8 @@ class QuizApp:
         self.root.unbind('<Return>')
         
         is_correct = self.logic.check_answer(self.difficulty, self.current_quiz, user_answer)
+        # 結果を元の行の苦手度に反映（次回以降の重み付き抽出で使う）
+        self.logic.record_result(self.current_quiz, is_correct)
 
         if is_correct:
             messagebox.showinfo("結果", "正解！")
@@ -509,6 +3780,16 @@ class QuizApp:
         self.selector_window.destroy()
         self.root.destroy()
 
+        # 運動している間に、次に起動したときの問題を作って保存しておく
+        handoff = None
+        if not self.keywords:
+            handoff = threading.Thread(
+                target=self.logic.save_handoff,
+                args=(self.difficulty, self.filename, self.sheet),
+                daemon=True,
+            )
+            handoff.start()
+
         try:
             # 外部プログラムを実行
             # 引数としてファイル名の後に不正解数を渡す
@@ -517,11 +3798,218 @@ class QuizApp:
             print(f"エラー: {program_file} が見つかりませんでした。")
         except Exception as e:
             print(f"実行エラー: {e}")
+
+        if handoff is not None and handoff.is_alive():
+            print("次の回の問題を保存しています...")
+            handoff.join()
             
 # ───────────────────────────────
-# ③ メイン実行処理
+# ③ 問題バンクの一括生成（GUIなし）
+# ───────────────────────────────
+def build_question_bank(logic, filename, sheet=0, difficulties=("初級", "中級"),
+                        window_rows=BUILD_WINDOW_ROWS, questions_per_window=BUILD_QUESTIONS_PER_WINDOW,
+                        concurrency=BUILD_CONCURRENCY, jsonl_path=None):
+    """
+    ワークブック全体を重ならない行の区間に分け、難易度ごとに問題を生成して問題バンクに保存する。
+    concurrency 件のリクエストを同時に送り続ける。処理済みの区間はバンクに記録するので、
+    途中で止めても次回は続きから再開する（行の内容が変わった区間だけ作り直す）。
+    jsonl_path を指定すると、新しく保存した問題を1行1問で追記する。
+    """
+    bank = logic.question_bank or QuestionBank()
+    book = logic.workbook_cache.load(filename, sheet)
+    source = logic.bank_source(filename, sheet)
+    # 接続プールより多く送ると、溢れた分は接続待ちのままタイムアウトしてしまう
+    # （応答確認の分も1本空けておく）
+    if concurrency > logic.max_connections - 1:
+        concurrency = max(1, logic.max_connections - 1)
+        print(f"接続数の上限に合わせて、同時リクエスト数を {concurrency} にします"
+              f"（QuizLogic(max_connections=...) で増やせます）")
+
+    jobs = []
+    for start in range(0, len(book), window_rows):
+        rows = book.selection(range(start, min(start + window_rows, len(book))))
+        window_key = hashlib.blake2b(
+            "".join(key for key, _ in rows).encode("ascii"), digest_size=16
+        ).hexdigest()
+        for difficulty in difficulties:
+            if not bank.window_done(source, difficulty, window_key):
+                jobs.append((difficulty, rows, window_key))
+
+    total_windows = -(-len(book) // window_rows) * len(difficulties)
+    print(f"{source}: {len(book)}行 / 区間 {total_windows}件のうち残り {len(jobs)}件")
+    if not jobs:
+        return 0
+
+    jsonl_lock = threading.Lock()
+
+    def run(job):
+        difficulty, rows, window_key = job
+        prompt = logic.build_prompt(difficulty, "".join(line for _, line in rows), questions_per_window)
+        text, model = logic.request_completion(prompt, difficulty)
+        quiz_list = logic.attach_model(logic.parse_quiz_text(text, difficulty), model) or []
+        # 過去の問題の言い換えは入れない
+        fingerprints = {}
+        quiz_list = [quiz for quiz in quiz_list if logic.is_new_question(quiz, fingerprints)]
+        logic.attach_source_rows(quiz_list, rows)
+        # 重複する問題文はバンク側で捨てられる。指紋はバンクに入った問題だけ登録する
+        added = bank.add(source, difficulty, quiz_list)
+        logic.remember_questions(added, fingerprints)
+        if jsonl_path and added:
+            with jsonl_lock, open(jsonl_path, "a", encoding="utf-8") as f:
+                for quiz in added:
+                    record = dict(quiz, source=source, difficulty=difficulty)
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        bank.mark_window(source, difficulty, window_key)
+        return len(added)
+
+    started = time.time()
+    done = failed = questions = 0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = [pool.submit(run, job) for job in jobs]
+        for future in as_completed(futures):
+            try:
+                questions += future.result()
+                done += 1
+            except Exception as e:
+                # 失敗した区間は記録しないので、次回の実行でやり直す
+                failed += 1
+                print(f"Error generating quiz: {e}")
+            elapsed = max(time.time() - started, 1e-9)
+            print(
+                f"[{done + failed}/{len(jobs)}] 新しい問題 {questions}問"
+                f"（失敗 {failed}件, {elapsed:.0f}秒, {questions / elapsed * 60:.1f}問/分）"
+            )
+            # 指紋はメモリ上では区間ごとに登録済み。ファイルへはまとめて書き出す
+            if (done + failed) % BUILD_SAVE_EVERY == 0:
+                logic.save_fingerprints()
+    logic.save_fingerprints()
+    return questions
+
+
+def main_build_bank(argv=None):
+    """コマンドラインから問題バンクを一括生成する"""
+    parser = argparse.ArgumentParser(description="問題バンクを一括生成します（GUIは起動しません）")
+    parser.add_argument("--build-bank", action="store_true")
+    parser.add_argument("--file", default="data.xlsx", help="Excelファイル")
+    parser.add_argument("--sheet", type=int, default=0, help="シート番号")
+    parser.add_argument("--difficulty", action="append", choices=["初級", "中級"],
+                        help="生成する難易度（複数指定可。省略時は両方）")
+    parser.add_argument("--window", type=int, default=BUILD_WINDOW_ROWS, help="1リクエストの行数")
+    parser.add_argument("--questions", type=int, default=BUILD_QUESTIONS_PER_WINDOW,
+                        help="1リクエストで作る問題数")
+    parser.add_argument("--concurrency", type=int, default=BUILD_CONCURRENCY,
+                        help="同時に送るリクエスト数")
+    parser.add_argument("--jsonl", help="新しい問題を追記するJSONLファイル")
+    args = parser.parse_args(argv)
+
+    # 同時リクエスト数に応答確認の分を足した接続を用意する
+    logic = QuizLogic(max_connections=max(HTTP_MAX_CONNECTIONS, args.concurrency + 1))
+    build_question_bank(
+        logic, args.file, args.sheet, tuple(args.difficulty or ("初級", "中級")),
+        args.window, args.questions, args.concurrency, args.jsonl,
+    )
+
+
+class _StubLLMHandler(BaseHTTPRequestHandler):
+    """check_endpoint_pool 用の OpenAI 互換スタブ（/models と /chat/completions だけ）"""
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self._reply({"object": "list", "data": [{"id": self.server.model, "object": "model"}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        quiz = {"question": "CPUの役割は？", "choices": ["演算", "記憶", "通信"], "answer": "演算"}
+        self._reply({
+            "id": "stub", "object": "chat.completion", "created": 0, "model": self.server.model,
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": json.dumps([quiz], ensure_ascii=False)}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 20, "total_tokens": 30},
+        })
+
+    def _reply(self, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def _check(condition, message):
+    """確認に失敗したら止める（python -O でも省かれないよう assert は使わない）"""
+    if not condition:
+        raise RuntimeError(message)
+
+
+def check_endpoint_pool():
+    """
+    EndpointPool の振り分けと応答確認を、手元に立てたスタブサーバーで確かめる。
+    python ITgakusyu.py --check-endpoints で実行する（AIサーバーは不要）。
+
+    - fast（初級のみ・速い）, slow（全難易度・遅い）, down（接続できない）の3台を用意する
+    - 応答確認で down が使えない扱いになり、難易度ごとに速い方へ振り分けられること
+    - 問い合わせの結果に、応答したサーバーのモデル名が記録されること
+    - 止まったサーバーは使えない扱いになり、他のサーバーに切り替わること
+    """
+    servers = []
+    for model, delay in (("fast-model", 0.0), ("slow-model", 0.2)):
+        server = ThreadingHTTPServer(("127.0.0.1", 0), _StubLLMHandler)
+        server.model, server.delay = model, delay
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+    fast, slow = (f"http://127.0.0.1:{server.server_address[1]}/v1" for server in servers)
+    # 一度開いてすぐ閉じたポートは、接続できないサーバーとして使える
+    closed = ThreadingHTTPServer(("127.0.0.1", 0), _StubLLMHandler)
+    down = f"http://127.0.0.1:{closed.server_address[1]}/v1"
+    closed.server_close()
+    configs = [
+        {"name": "fast", "base_url": fast, "model": "fast-model", "difficulties": ["初級"]},
+        {"name": "slow", "base_url": slow, "model": "slow-model"},
+        {"name": "down", "base_url": down, "model": "down-model"},
+    ]
+    with tempfile.TemporaryDirectory() as tmp, httpx.Client() as http_client:
+        pool = EndpointPool(configs, http_client, ThroughputStats(os.path.join(tmp, "throughput.json")))
+        by_name = {endpoint.name: endpoint for endpoint in pool.endpoints}
+        pool.probe_all()
+        _check(by_name["fast"].healthy and by_name["slow"].healthy, "スタブが応答しません")
+        _check(by_name["down"].healthy is False, "接続できないサーバーが使える扱いになっています")
+        _check(pool.choose("初級").name == "fast", "初級が速いサーバーに送られていません")
+        _check(pool.choose("中級").name == "slow", "初級専用のサーバーに中級が送られています")
+        _check(
+            pool.choose("初級", exclude=(by_name["fast"],)).name == "slow",
+            "除外したサーバーが選ばれています",
+        )
+
+        # 記録用のファイルは一時フォルダに作り、スクリプトの隣には残さない
+        logic = QuizLogic(data_dir=tmp)
+        logic.endpoints, logic.throughput = pool, pool.throughput
+        text, model = logic.request_completion([{"role": "user", "content": "test"}], "中級")
+        _check(model == "slow-model" and logic.parse_quiz_text(text), "応答したモデル名が違います")
+        if logic.question_bank is not None:
+            logic.question_bank.close()
+
+        servers[0].shutdown()
+        servers[0].server_close()
+        pool.probe(by_name["fast"])
+        _check(by_name["fast"].healthy is False, "止まったサーバーが使える扱いのままです")
+        _check(pool.choose(None).name == "slow", "止まったサーバーから切り替わっていません")
+    servers[1].shutdown()
+    servers[1].server_close()
+    print("EndpointPool: 振り分けと応答確認は正常です")
+
+
+# ───────────────────────────────
+# ④ メイン実行処理
 # ───────────────────────────────
 if __name__ == "__main__":
-    root = tk.Tk()
-    app = QuizApp(root)
-    root.mainloop()
+    if "--build-bank" in sys.argv[1:]:
+        main_build_bank()
+    elif "--check-endpoints" in sys.argv[1:]:
+        check_endpoint_pool()
+    else:
+        root = tk.Tk()
+        app = QuizApp(root)
+        root.mainloop()